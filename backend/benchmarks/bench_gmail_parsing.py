@@ -0,0 +1,264 @@
+"""
+Gmail Parsing Benchmarks
+Offline throughput and peak-memory benchmarks for the gmail_service
+functions on the sync path, run against a synthetic corpus of Gmail API
+message payloads.
+
+    python benchmarks/bench_gmail_parsing.py                  # run and compare with baseline
+    python benchmarks/bench_gmail_parsing.py --save-baseline  # record a new baseline
+    python benchmarks/bench_gmail_parsing.py --only plain html_only
+
+Exits with status 1 when a benchmark is more than --threshold slower than
+the stored baseline, so it can gate CI.
+"""
+
+import argparse
+import base64
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import gmail_service  # noqa: E402
+
+BASELINE_FILE = Path(__file__).with_name('baseline.json')
+
+_WORDS = ('invoice payment meeting project update schedule review report quarterly '
+          'team launch budget customer support release notes agenda follow-up').split()
+
+
+# ── Corpus ──────────────────────────────────────────────
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def _sentence(rng: random.Random, words: int = 12) -> str:
+    return ' '.join(rng.choice(_WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def _text(rng: random.Random, paragraphs: int) -> str:
+    return '\n\n'.join(' '.join(_sentence(rng) for _ in range(4)) for _ in range(paragraphs))
+
+
+def _html(rng: random.Random, paragraphs: int) -> str:
+    rows = ''.join(
+        f'<tr><td class="cell" style="padding:8px">{_sentence(rng)} &amp; more&nbsp;&#8212;</td></tr>'
+        for _ in range(paragraphs)
+    )
+    return (
+        '<!DOCTYPE html><html><head><style>td{font-family:Arial}</style></head><body>'
+        f'<!-- tracking --><div><h1>{_sentence(rng, 5)}</h1><p>{_sentence(rng)}<br/>{_sentence(rng)}</p>'
+        f'<table>{rows}</table><script>var x = 1 < 2;</script></div></body></html>'
+    )
+
+
+def _headers(rng: random.Random, i: int) -> list:
+    return [
+        {'name': 'Delivered-To', 'value': 'me@example.com'},
+        {'name': 'Received', 'value': 'by 2002:a05:6a10:abcd with SMTP id x; Tue, 5 Mar 2024 10:00:00 -0800'},
+        {'name': 'From', 'value': f'"Sender {i}" <sender{i}@example.com>'},
+        {'name': 'To', 'value': 'Me <me@example.com>'},
+        {'name': 'Subject', 'value': _sentence(rng, 6)},
+        {'name': 'Date', 'value': f'Tue, {1 + i % 28} Mar 2024 10:{i % 60:02d}:00 -0800'},
+        {'name': 'Message-ID', 'value': f'<msg{i}@example.com>'},
+        {'name': 'MIME-Version', 'value': '1.0'},
+    ]
+
+
+def _message(i: int, payload: dict, rng: random.Random) -> dict:
+    payload = {**payload, 'headers': _headers(rng, i)}
+    return {
+        'id': f'{i:016x}', 'threadId': f'{i // 3:016x}',
+        'labelIds': ['INBOX', 'UNREAD'] if i % 2 else ['INBOX'],
+        'snippet': _sentence(rng), 'payload': payload,
+    }
+
+
+def _part(mime: str, data: bytes, charset: str = 'utf-8') -> dict:
+    return {
+        'mimeType': mime, 'filename': '',
+        'headers': [{'name': 'Content-Type', 'value': f'{mime}; charset="{charset}"'}],
+        'body': {'size': len(data), 'data': _b64(data)},
+    }
+
+
+def plain_payload(rng):
+    return _part('text/plain', _text(rng, 6).encode())
+
+
+def html_only_payload(rng):
+    return _part('text/html', _html(rng, 20).encode())
+
+
+def nested_payload(rng, depth=6):
+    """multipart/mixed wrapping several levels of multipart/alternative and an attachment."""
+    node = {'mimeType': 'multipart/alternative', 'parts': [
+        _part('text/plain', _text(rng, 3).encode()),
+        _part('text/html', _html(rng, 10).encode()),
+    ]}
+    for _ in range(depth):
+        node = {'mimeType': 'multipart/alternative', 'parts': [node]}
+    attachment = {'mimeType': 'application/pdf', 'filename': 'report.pdf',
+                  'body': {'attachmentId': 'ANGjdJ8', 'size': 52000}}
+    return {'mimeType': 'multipart/mixed', 'parts': [node, attachment]}
+
+
+def newsletter_payload(rng, size=1024 * 1024):
+    """~1 MB HTML-only newsletter."""
+    html_body = _html(rng, 20)
+    while len(html_body) < size:
+        html_body += _html(rng, 40)
+    return _part('text/html', html_body.encode())
+
+
+def non_utf8_payload(rng):
+    """Latin-1 and Shift_JIS bodies, which Gmail passes through undecoded."""
+    return {'mimeType': 'multipart/alternative', 'parts': [
+        _part('text/plain', ('Café crème, déjà vu. ' * 40).encode('latin-1'), 'iso-8859-1'),
+        _part('text/html', ('<p>会議の議事録を送ります。</p>' * 40).encode('shift_jis'), 'shift_jis'),
+    ]}
+
+
+CORPUS_KINDS = {
+    'plain': (plain_payload, 2000),
+    'html_only': (html_only_payload, 1000),
+    'nested': (nested_payload, 1000),
+    'newsletter_1mb': (newsletter_payload, 5),
+    'non_utf8': (non_utf8_payload, 1000),
+}
+
+
+def build_corpus(seed: int = 1234, scale: float = 1.0) -> dict:
+    """{kind: [gmail message dicts]}, deterministic for a given seed."""
+    rng = random.Random(seed)
+    corpus = {}
+    for kind, (factory, count) in CORPUS_KINDS.items():
+        corpus[kind] = [_message(i, factory(rng), rng) for i in range(max(1, int(count * scale)))]
+    return corpus
+
+
+# ── Benchmarks ──────────────────────────────────────────
+
+def _per_message_inputs(func_name: str, messages: list) -> list:
+    """Argument tuples for one call per message."""
+    if func_name == '_gmail_msg_to_dict':
+        return [(m, 'me@example.com') for m in messages]
+    if func_name == '_get_email_body':
+        return [(m['payload'],) for m in messages]
+    headers = [m['payload']['headers'] for m in messages]
+    if func_name == '_parse_email_headers':
+        return [(h,) for h in headers]
+    parsed = [gmail_service._parse_email_headers(h) for h in headers]
+    if func_name == '_parse_name_email':
+        return [(p['from'],) for p in parsed]
+    if func_name == '_parse_gmail_date':
+        return [(p['date'],) for p in parsed]
+    raise ValueError(func_name)
+
+
+FUNCTIONS = ('_gmail_msg_to_dict', '_get_email_body', '_parse_email_headers',
+             '_parse_name_email', '_parse_gmail_date')
+
+
+def run_benchmark(func, inputs: list, min_time: float) -> dict:
+    """Throughput over repeated passes for at least min_time seconds, then one
+    more pass under tracemalloc for peak memory."""
+    passes = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time or passes < 1:
+        for args in inputs:
+            func(*args)
+        passes += 1
+        elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for args in inputs:
+        func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'msgs_per_sec': round(passes * len(inputs) / elapsed, 1),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def run_suite(corpus: dict, min_time: float, kinds=None) -> dict:
+    results = {}
+    for kind, messages in corpus.items():
+        if kinds and kind not in kinds:
+            continue
+        for func_name in FUNCTIONS:
+            inputs = _per_message_inputs(func_name, messages)
+            results[f'{func_name}[{kind}]'] = run_benchmark(getattr(gmail_service, func_name), inputs, min_time)
+    return results
+
+
+# ── Baseline ────────────────────────────────────────────
+
+def load_baseline() -> dict:
+    if not BASELINE_FILE.exists():
+        return {}
+    return json.loads(BASELINE_FILE.read_text()).get('results', {})
+
+
+def save_baseline(results: dict):
+    BASELINE_FILE.write_text(json.dumps({
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }, indent=2, sort_keys=True) + '\n')
+
+
+def report(results: dict, baseline: dict, threshold: float) -> list:
+    """Print a results table and return the names of regressed benchmarks."""
+    regressions = []
+    print(f"{'benchmark':<44}{'msgs/s':>12}{'baseline':>12}{'change':>9}{'peak KiB':>11}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        change = ''
+        if base:
+            ratio = result['msgs_per_sec'] / base['msgs_per_sec'] - 1
+            change = f'{ratio:+.0%}'
+            if ratio < -threshold:
+                change += ' !'
+                regressions.append(name)
+        print(f"{name:<44}{result['msgs_per_sec']:>12,.0f}"
+              f"{(base or {}).get('msgs_per_sec', 0):>12,.0f}{change:>9}{result['peak_kib']:>11,.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown against the baseline (default 0.2 = 20%%)')
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds spent per benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply corpus sizes')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--only', nargs='*', choices=sorted(CORPUS_KINDS), help='corpus kinds to run')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.seed, args.scale)
+    results = run_suite(corpus, args.min_time, args.only)
+    regressions = report(results, {} if args.save_baseline else load_baseline(), args.threshold)
+
+    if args.save_baseline:
+        save_baseline(results)
+        print(f'\nBaseline saved to {BASELINE_FILE}')
+    elif regressions:
+        print(f'\n{len(regressions)} benchmark(s) more than {args.threshold:.0%} slower than baseline')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Gmail Sync Benchmarks
+Times fetch_emails and check_new_emails against replayed Gmail responses
+(see gmail_transport), with optional latency and fault injection.
+
+    python benchmarks/bench_gmail_sync.py                          # synthetic mailbox
+    python benchmarks/bench_gmail_sync.py --fixtures fixtures/gmail --history-id 123456
+    python benchmarks/bench_gmail_sync.py --latency 20-80 --faults 429:0.05,503:0.01
+    python benchmarks/bench_gmail_sync.py --quota 250                  # throttle like Gmail's per-user limit
+
+Fixtures for a real account are recorded by running the server once with
+GMAIL_TRANSPORT=record; replaying them needs the history ID of that session.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+GMAIL_API = 'https://gmail.googleapis.com/gmail/v1/users/me'
+HISTORY_TYPES = ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+
+
+def _metadata_only(message: dict) -> dict:
+    payload = message['payload']
+    return {**message, 'payload': {'mimeType': payload.get('mimeType', ''), 'headers': payload['headers']}}
+
+
+def write_synthetic_fixtures(store, folder_size: int, new_messages: int, seed: int):
+    """Profile, inbox/sent listings, every message in metadata and full
+    format, and one history page adding new_messages to the inbox."""
+    from bench_gmail_parsing import build_corpus
+    from gmail_service import METADATA_HEADERS
+
+    # A few hundred distinct payloads; folders cycle through them
+    corpus = build_corpus(seed, scale=0.1)
+    pool = [m for kind, messages in corpus.items() if kind != 'newsletter_1mb' for m in messages]
+    messages = {}
+    for folder, label in (('inbox', 'INBOX'), ('sent', 'SENT')):
+        listing = []
+        for i in range(folder_size):
+            msg = pool[len(messages) % len(pool)]
+            msg = {**msg, 'id': f'{folder[0]}{i:015x}', 'labelIds': [label], 'historyId': '1000'}
+            messages[msg['id']] = msg
+            listing.append({'id': msg['id'], 'threadId': msg['threadId']})
+        store.add('GET', f'{GMAIL_API}/messages?q=in:{folder}&maxResults={folder_size}', 200,
+                  json.dumps({'messages': listing, 'resultSizeEstimate': folder_size}))
+
+    added = []
+    for i in range(new_messages):
+        msg = {**pool[i % len(pool)], 'id': f'n{i:015x}', 'labelIds': ['INBOX', 'UNREAD'], 'historyId': '1001'}
+        messages[msg['id']] = msg
+        added.append({'id': str(1001 + i), 'messagesAdded': [{'message': {
+            'id': msg['id'], 'threadId': msg['threadId'], 'labelIds': msg['labelIds']}}]})
+
+    metadata_query = '&'.join(f'metadataHeaders={h}' for h in METADATA_HEADERS)
+    for msg_id, msg in messages.items():
+        store.add('GET', f'{GMAIL_API}/messages/{msg_id}?format=full', 200, json.dumps(msg))
+        store.add('GET', f'{GMAIL_API}/messages/{msg_id}?format=metadata&{metadata_query}', 200,
+                  json.dumps(_metadata_only(msg)))
+
+    history_types = '&'.join(f'historyTypes={t}' for t in HISTORY_TYPES)
+    store.add('GET', f'{GMAIL_API}/history?startHistoryId=1000&{history_types}', 200,
+              json.dumps({'history': added, 'historyId': str(1000 + new_messages)}))
+    store.add('GET', f'{GMAIL_API}/profile', 200, json.dumps({
+        'emailAddress': 'me@example.com', 'messagesTotal': len(messages),
+        'threadsTotal': len(messages), 'historyId': '1000',
+    }))
+
+
+def timed(label: str, func, messages_per_call, repeat: int, transport) -> dict:
+    """Run func `repeat` times; throughput counts messages actually returned."""
+    import gmail_service
+    transport.store.rewind()
+    requests_before = transport.requests
+    returned = 0
+    errors = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        gmail_service._clear_profile_cache()
+        try:
+            returned += messages_per_call(func())
+        except Exception:
+            errors += 1
+        transport.store.rewind()
+    elapsed = time.perf_counter() - start
+    result = {
+        'msgs_per_sec': round(returned / elapsed, 1),
+        'calls_per_sec': round(repeat / elapsed, 2),
+        'http_requests': transport.requests - requests_before,
+        'failed_calls': errors,
+        'messages': returned,
+    }
+    print(f"{label:<28}{result['msgs_per_sec']:>12,.0f}{result['calls_per_sec']:>10,.2f}"
+          f"{result['http_requests']:>10}{result['messages']:>10}{errors:>8}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', help='replay this fixture directory instead of a synthetic mailbox')
+    parser.add_argument('--history-id', default='1000', help='start history ID for check_new_emails')
+    parser.add_argument('--folder-size', type=int, default=200, help='synthetic messages per folder')
+    parser.add_argument('--new-messages', type=int, default=50, help='synthetic messages in the history page')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--latency', default='0', help='per-request latency in ms, e.g. 40 or 20-80')
+    parser.add_argument('--faults', default='', help='e.g. 429:0.05,503:0.02,history_expired:0.1')
+    parser.add_argument('--quota', default='1000000',
+                        help='Gmail quota units per second (Gmail allows 250; default effectively unlimited)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    fixtures = args.fixtures or tempfile.mkdtemp(prefix='gmail-fixtures-')
+    os.environ.update({
+        'GMAIL_TRANSPORT': 'replay',
+        'GMAIL_FIXTURES_DIR': fixtures,
+        'GMAIL_TRANSPORT_LATENCY_MS': args.latency,
+        'GMAIL_TRANSPORT_FAULTS': args.faults,
+        'GMAIL_TRANSPORT_SEED': str(args.seed),
+        'GMAIL_QUOTA_UNITS_PER_SECOND': args.quota,
+        'GMAIL_QUOTA_BURST_UNITS': args.quota,
+    })
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+
+    import gmail_service
+    import gmail_transport
+    from gmail_quota import gmail_quota
+
+    transport = gmail_transport.replay_http()
+    if not args.fixtures:
+        write_synthetic_fixtures(transport.store, args.folder_size, args.new_messages, args.seed)
+    size = args.folder_size
+
+    print(f"{'benchmark':<28}{'msgs/s':>12}{'calls/s':>10}{'requests':>10}{'messages':>10}{'failed':>8}")
+    results = {
+        'fetch_emails[metadata]': timed(
+            'fetch_emails[metadata]', lambda: gmail_service.fetch_emails('inbox', size, 'metadata'),
+            len, args.repeat, transport),
+        'fetch_emails[full]': timed(
+            'fetch_emails[full]', lambda: gmail_service.fetch_emails('inbox', size, 'full'),
+            len, args.repeat, transport),
+        'check_new_emails': timed(
+            'check_new_emails', lambda: gmail_service.check_new_emails(args.history_id),
+            lambda result: len(result[0]), args.repeat, transport),
+    }
+    quota = gmail_quota.status()
+    print(f"\ninjected faults: {transport.faults.injected or 'none'}, missing fixtures: {transport.missing}, "
+          f"retries: {quota['retries']}, gave up: {quota['gave_up']}")
+    if args.json:
+        print(json.dumps({'results': results, 'injected': {str(k): v for k, v in transport.faults.injected.items()},
+                          'missing': transport.missing, 'quota': quota}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
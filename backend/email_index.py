@@ -0,0 +1,129 @@
+"""
+Email Retrieval Index
+In-process BM25 index over the local mailbox, used to pick the emails that
+are sent to the AI assistant. No external services; updated incrementally
+as emails are synced, changed or deleted.
+"""
+
+import math
+import re
+from collections import Counter, defaultdict
+
+_TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+_STOPWORDS = frozenset("""
+a an and are as at be by can do for from has have i in is it me my of on or
+please show that the this to was what when where which with you your
+""".split())
+
+_MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+           'august', 'september', 'october', 'november', 'december']
+
+# Fields copied into the index so results can be rendered without a DB query
+META_FIELDS = ('id', 'folder', 'date', 'from_name', 'from_email', 'to_email',
+               'subject', 'preview', 'is_read', 'starred')
+
+# Field repetition acts as a cheap field weight in BM25
+_FIELD_WEIGHTS = (('subject', 3), ('from_name', 2), ('from_email', 2), ('to_email', 1),
+                  ('preview', 1), ('body', 1))
+_BODY_CHARS = 4000
+
+
+def tokenize(text: str) -> list:
+    """Lowercase word tokens without stopwords."""
+    return [t for t in _TOKEN_RE.findall((text or '').lower()) if t not in _STOPWORDS]
+
+
+def _date_tokens(date: str) -> list:
+    """'2024-03-05T…' -> ['march', '2024'] so questions like "from March" match."""
+    try:
+        year, month = date[:4], int(date[5:7])
+        return [_MONTHS[month - 1], year]
+    except (ValueError, IndexError, TypeError):
+        return []
+
+
+def _email_terms(email: dict) -> Counter:
+    terms = Counter()
+    for field, weight in _FIELD_WEIGHTS:
+        value = email.get(field) or ''
+        if field == 'body':
+            value = value[:_BODY_CHARS]
+        for token in tokenize(value):
+            terms[token] += weight
+    for token in _date_tokens(email.get('date', '')):
+        terms[token] += 1
+    return terms
+
+
+class EmailIndex:
+    """BM25 index keyed by email id."""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.meta = {}                      # id -> META_FIELDS
+        self._terms = {}                    # id -> Counter of term frequencies
+        self._lengths = {}                  # id -> document length in terms
+        self._postings = defaultdict(dict)  # term -> {id: tf}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._terms)
+
+    def clear(self):
+        self.meta.clear()
+        self._terms.clear()
+        self._lengths.clear()
+        self._postings.clear()
+        self._total_length = 0
+
+    def add(self, email: dict):
+        """Index an email, replacing any previous version with the same id."""
+        email_id = email.get('id')
+        if not email_id:
+            return
+        self.remove(email_id)
+        terms = _email_terms(email)
+        self._terms[email_id] = terms
+        self._lengths[email_id] = sum(terms.values())
+        self._total_length += self._lengths[email_id]
+        for term, tf in terms.items():
+            self._postings[term][email_id] = tf
+        self.meta[email_id] = {field: email[field] for field in META_FIELDS if field in email}
+
+    def update(self, email_id: str, fields: dict):
+        """Update stored metadata (e.g. is_read/starred) without reindexing text."""
+        if email_id in self.meta:
+            self.meta[email_id].update({k: v for k, v in fields.items() if k in META_FIELDS})
+
+    def remove(self, email_id: str):
+        terms = self._terms.pop(email_id, None)
+        if terms is None:
+            return
+        self._total_length -= self._lengths.pop(email_id)
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(email_id, None)
+                if not postings:
+                    del self._postings[term]
+        self.meta.pop(email_id, None)
+
+    def search(self, query: str, k: int = 10) -> list:
+        """Return up to k (email_id, score) pairs, best first."""
+        n = len(self._terms)
+        if not n:
+            return []
+        avg_length = self._total_length / n
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for email_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[email_id] / avg_length)
+                scores[email_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (item[1], self.meta[item[0]].get('date') or ''), reverse=True)
+        return ranked[:k]
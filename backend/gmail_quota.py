@@ -0,0 +1,237 @@
+"""
+Gmail Quota
+Shared client layer for Gmail API calls: a token bucket sized in Gmail
+quota units, a cap on concurrent requests, and retries with exponential
+backoff and jitter for rate-limit and server errors (honouring Retry-After).
+
+Gmail allows 250 quota units per user per second; each method costs a
+fixed number of units (messages.get 5, messages.send 100, ...). See
+https://developers.google.com/gmail/api/reference/quota
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+logger = logging.getLogger(__name__)
+
+# Quota units per API method (discovery method id)
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.list': 1,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.send': 100,
+    'gmail.users.threads.get': 10,
+    'gmail.users.threads.list': 10,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+# Not safe to resend after a server error, since Gmail may already have acted
+NON_IDEMPOTENT_METHODS = frozenset(('gmail.users.messages.send', 'gmail.users.drafts.send'))
+
+RETRYABLE_STATUSES = frozenset((429, 500, 502, 503, 504))
+# Gmail reports per-user rate limits as 403 with one of these reasons
+RATE_LIMIT_REASONS = frozenset(('rateLimitExceeded', 'userRateLimitExceeded'))
+
+
+def quota_units(method_id: str) -> int:
+    return QUOTA_UNITS.get(method_id, DEFAULT_QUOTA_UNITS)
+
+
+def _error_reason(error: HttpError) -> str:
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return ''
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """429, or 403 with a rate-limit reason."""
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and _error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error: Exception, idempotent: bool = True) -> bool:
+    """Rate limits are always retried; server and transport errors only for
+    requests that are safe to send twice."""
+    if is_rate_limited(error):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+
+def retry_after(error: Exception):
+    """Seconds from a Retry-After header (delta or HTTP date), or None."""
+    resp = getattr(error, 'resp', None)
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Thread-safe token bucket. Requests larger than the bucket are let
+    through once it is full and leave it in debt, so they still pay in full."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, units: float) -> float:
+        """Block until `units` are available, then take them. Returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= min(units, self.capacity):
+                    self.tokens -= units
+                    return waited
+                wait = max(self.paused_until - now, (min(units, self.capacity) - self.tokens) / self.rate)
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float):
+        """Hold every caller back, e.g. after Gmail answered 429."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def snapshot(self) -> tuple:
+        """(available tokens, seconds left in a pause)."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self.tokens, max(0.0, self.paused_until - now)
+
+
+class GmailQuota:
+    """Rate limiting, concurrency cap and retries shared by every Gmail call."""
+
+    def __init__(self, units_per_second: float, burst: float, max_concurrency: int,
+                 max_retries: int, base_delay: float, max_delay: float):
+        self.bucket = TokenBucket(units_per_second, burst)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {
+            'requests': 0, 'units': 0, 'retries': 0, 'rate_limited': 0, 'server_errors': 0,
+            'transport_errors': 0, 'gave_up': 0, 'throttled_seconds': 0.0, 'backoff_seconds': 0.0,
+        }
+
+    def _count(self, name: str, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def backoff(self, attempt: int, error: Exception = None) -> float:
+        """Full-jitter exponential backoff, never shorter than Retry-After."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        server_delay = retry_after(error) if error is not None else None
+        if server_delay is not None:
+            delay = max(delay, min(server_delay, self.max_delay))
+        return delay
+
+    def record_error(self, error: Exception):
+        """Count a failed call (or batch item) and slow everyone down on rate limits."""
+        if is_rate_limited(error):
+            self._count('rate_limited')
+            self.bucket.pause(retry_after(error) or self.base_delay)
+        elif isinstance(error, HttpError):
+            if error.resp.status >= 500:
+                self._count('server_errors')
+        elif isinstance(error, (OSError, httplib2.HttpLib2Error)):
+            self._count('transport_errors')
+
+    def sleep_before_retry(self, attempt: int, error: Exception = None):
+        delay = self.backoff(attempt, error)
+        self._count('retries')
+        self._count('backoff_seconds', delay)
+        time.sleep(delay)
+
+    def call(self, send, units: int, idempotent: bool = True):
+        """Run send() (one HTTP attempt) within the quota, retrying transient failures."""
+        attempt = 0
+        while True:
+            self._count('throttled_seconds', self.bucket.acquire(units))
+            with self._slots:
+                with self._lock:
+                    self.in_flight += 1
+                    self.counters['requests'] += 1
+                    self.counters['units'] += units
+                try:
+                    return send()
+                except Exception as e:
+                    error = e
+                finally:
+                    with self._lock:
+                        self.in_flight -= 1
+            self.record_error(error)
+            if not is_retryable(error, idempotent):
+                raise error
+            if attempt >= self.max_retries:
+                self._count('gave_up')
+                raise error
+            logger.warning(f"Gmail request failed ({error}), retry {attempt + 1}/{self.max_retries}")
+            self.sleep_before_retry(attempt, error)
+            attempt += 1
+
+    def status(self) -> dict:
+        tokens, paused_for = self.bucket.snapshot()
+        with self._lock:
+            counters = dict(self.counters)
+            in_flight = self.in_flight
+        return {
+            'units_per_second': self.bucket.rate,
+            'burst_units': self.bucket.capacity,
+            'available_units': round(tokens, 1),
+            'paused_seconds': round(paused_for, 2),
+            'max_concurrency': self.max_concurrency,
+            'in_flight': in_flight,
+            'max_retries': self.max_retries,
+            **{k: round(v, 3) if isinstance(v, float) else v for k, v in counters.items()},
+        }
+
+
+gmail_quota = GmailQuota(
+    # Gmail's per-user limit is 250 units/s; stay a little under it by default
+    units_per_second=float(os.environ.get('GMAIL_QUOTA_UNITS_PER_SECOND', '200')),
+    burst=float(os.environ.get('GMAIL_QUOTA_BURST_UNITS', '250')),
+    max_concurrency=int(os.environ.get('GMAIL_MAX_CONCURRENT_REQUESTS', '4')),
+    max_retries=int(os.environ.get('GMAIL_MAX_RETRIES', '5')),
+    base_delay=float(os.environ.get('GMAIL_RETRY_BASE_DELAY', '0.5')),
+    max_delay=float(os.environ.get('GMAIL_RETRY_MAX_DELAY', '32')),
+)
@@ -6,17 +6,26 @@ Uses OAuth2 refresh token for server-side authentication.
 
 import os
 import base64
+import html
 import logging
+import re
+import threading
+import time
 import email
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import Optional
 from datetime import datetime, timezone
 
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+import gmail_transport
+from gmail_quota import gmail_quota, quota_units, is_retryable, NON_IDEMPOTENT_METHODS
+from metrics import gmail_request_seconds, gmail_batch_items
+
 logger = logging.getLogger(__name__)
 
 # Gmail API scopes
@@ -26,9 +35,31 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify',
 ]
 
+# Gmail allows up to 100 calls per batch request, but large batches tend to
+# trip the per-user concurrency limit, so default to something smaller.
+GMAIL_BATCH_SIZE = max(1, min(100, int(os.environ.get('GMAIL_BATCH_SIZE', '50'))))
+
+# How long the authenticated user's profile is reused before asking Gmail again
+PROFILE_CACHE_TTL = int(os.environ.get('GMAIL_PROFILE_CACHE_TTL', '300'))
+
+# 'metadata' syncs only headers + snippet and loads bodies on first open;
+# 'full' downloads and parses every message body up front.
+GMAIL_SYNC_FORMAT = os.environ.get('GMAIL_SYNC_FORMAT', 'metadata')
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date', 'Message-ID', 'In-Reply-To', 'References']
+
+
+class HistoryExpiredError(Exception):
+    """Raised when Gmail no longer has history for a start history ID (HTTP 404)."""
+
+
+class GmailProfileError(Exception):
+    """Raised when the Gmail profile (account and history ID) can't be fetched."""
+
 
 def is_gmail_configured() -> bool:
-    """Check if Gmail credentials are available."""
+    """Check if Gmail credentials are available (or recorded responses are replayed)."""
+    if gmail_transport.replaying():
+        return True
     return bool(
         os.environ.get('GMAIL_CLIENT_ID')
         and os.environ.get('GMAIL_CLIENT_SECRET')
@@ -36,33 +67,143 @@ def is_gmail_configured() -> bool:
     )
 
 
+# Process-wide credentials, shared by every thread. The access token is kept
+# until it expires instead of being refreshed on every call.
+_creds_lock = threading.Lock()
+_cached_creds = None
+
+# httplib2 connections are not thread-safe, so each thread gets its own
+# service object built on top of the shared credentials.
+_thread_local = threading.local()
+
+# Raw users.getProfile response plus its expiry (time.monotonic()). The
+# historyId is advanced from later responses so it rarely needs a refetch.
+_profile_lock = threading.Lock()
+_profile_cache = None
+
+
+def _get_credentials() -> Credentials:
+    """Return cached OAuth credentials, refreshing the access token if needed."""
+    global _cached_creds
+    with _creds_lock:
+        refresh_token = os.environ['GMAIL_REFRESH_TOKEN']
+        if _cached_creds is None or _cached_creds.refresh_token != refresh_token:
+            _cached_creds = Credentials(
+                token=None,
+                refresh_token=refresh_token,
+                token_uri='https://oauth2.googleapis.com/token',
+                client_id=os.environ['GMAIL_CLIENT_ID'],
+                client_secret=os.environ['GMAIL_CLIENT_SECRET'],
+                scopes=SCOPES,
+            )
+            _clear_profile_cache()
+        if not _cached_creds.valid:
+            _cached_creds.refresh(Request())
+        return _cached_creds
+
+
 def get_gmail_service():
-    """Build authenticated Gmail API service using refresh token."""
-    creds = Credentials(
-        token=None,
-        refresh_token=os.environ['GMAIL_REFRESH_TOKEN'],
-        token_uri='https://oauth2.googleapis.com/token',
-        client_id=os.environ['GMAIL_CLIENT_ID'],
-        client_secret=os.environ['GMAIL_CLIENT_SECRET'],
-        scopes=SCOPES,
+    """Return an authenticated Gmail API service for the current thread."""
+    # Replayed responses need no credentials (see gmail_transport)
+    creds = None if gmail_transport.replaying() else _get_credentials()
+    cached = getattr(_thread_local, 'service', None)
+    if cached is None or cached[0] is not creds:
+        http = gmail_transport.build_http(creds)
+        if http is not None:
+            service = build('gmail', 'v1', http=http)
+        else:
+            service = build('gmail', 'v1', credentials=creds)
+        _thread_local.service = (creds, service)
+    return _thread_local.service[1]
+
+
+def invalidate_gmail_service():
+    """Drop cached credentials and services, e.g. after GMAIL_REFRESH_TOKEN changes."""
+    global _cached_creds
+    with _creds_lock:
+        _cached_creds = None
+    _clear_profile_cache()
+
+
+def _execute(request, units: int = None):
+    """Execute a Gmail API request (or batch) within the shared quota, retrying
+    rate limits and transient errors (see gmail_quota). Batches pass the
+    summed units of their calls."""
+    method = getattr(request, 'methodId', None)
+    return gmail_quota.call(
+        lambda: _execute_once(request),
+        units if units is not None else quota_units(method),
+        idempotent=method not in NON_IDEMPOTENT_METHODS,
     )
-    service = build('gmail', 'v1', credentials=creds)
-    return service
+
+
+def _execute_once(request):
+    """One HTTP attempt, recording its latency by API method."""
+    labels = {'method': getattr(request, 'methodId', None) or 'batch', 'status': 'ok'}
+    start = time.perf_counter()
+    try:
+        return request.execute()
+    except HttpError as e:
+        labels['status'] = str(e.resp.status)
+        raise
+    except Exception:
+        labels['status'] = 'error'
+        raise
+    finally:
+        gmail_request_seconds.observe(time.perf_counter() - start, **labels)
+
+
+def _clear_profile_cache():
+    global _profile_cache
+    with _profile_lock:
+        _profile_cache = None
+
+
+def _get_profile(service) -> dict:
+    """Return the raw Gmail profile, served from cache while it is fresh."""
+    global _profile_cache
+    with _profile_lock:
+        if _profile_cache and _profile_cache['expires_at'] > time.monotonic():
+            return _profile_cache['profile']
+    profile = _execute(service.users().getProfile(userId='me'))
+    with _profile_lock:
+        _profile_cache = {'profile': profile, 'expires_at': time.monotonic() + PROFILE_CACHE_TTL}
+    return profile
+
+
+def _note_history_id(history_id):
+    """Advance the cached profile's historyId from a messages/threads/history response."""
+    if not history_id:
+        return
+    with _profile_lock:
+        if not _profile_cache:
+            return
+        current = _profile_cache['profile'].get('historyId')
+        if not current or int(history_id) > int(current):
+            _profile_cache['profile'] = {**_profile_cache['profile'], 'historyId': str(history_id)}
 
 
 def get_user_profile() -> dict:
     """Get the authenticated user's Gmail profile."""
     try:
-        service = get_gmail_service()
-        profile = service.users().getProfile(userId='me').execute()
+        profile = _get_profile(get_gmail_service())
         return {
             'email': profile.get('emailAddress', ''),
             'total_messages': profile.get('messagesTotal', 0),
             'total_threads': profile.get('threadsTotal', 0),
+            'history_id': profile.get('historyId'),
         }
     except Exception as e:
         logger.error(f"Failed to get user profile: {e}")
-        return {'email': '', 'total_messages': 0, 'total_threads': 0}
+        return {'email': '', 'total_messages': 0, 'total_threads': 0, 'history_id': None}
+
+
+def require_user_profile() -> dict:
+    """Like get_user_profile, but raises GmailProfileError instead of returning an empty profile."""
+    profile = get_user_profile()
+    if not profile['email']:
+        raise GmailProfileError("Could not fetch the Gmail profile")
+    return profile
 
 
 def _parse_email_headers(headers: list) -> dict:
@@ -86,39 +227,104 @@ def _parse_name_email(raw: str) -> tuple:
     return (raw.split('@')[0], raw.strip())
 
 
+# HTML → text in one regex pass: drop comments and script/style/head blocks,
+# turn block-level tags into line breaks and remove every other tag.
+_HTML_TOKEN_RE = re.compile(
+    r'<!--.*?-->|<(script|style|head)\b.*?</\1\s*>|<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*>',
+    re.DOTALL | re.IGNORECASE,
+)
+# Openers and closers of blocks whose content is never text
+_HTML_HIDDEN_OPEN_RE = re.compile(r'<(?:(!--)|(script|style)\b)', re.IGNORECASE)
+_HTML_HIDDEN_CLOSE_RE = {
+    '!--': re.compile(r'-->'),
+    'script': re.compile(r'</script', re.IGNORECASE),
+    'style': re.compile(r'</style', re.IGNORECASE),
+}
+_HTML_BLOCK_TAGS = frozenset((
+    'br', 'p', 'div', 'tr', 'li', 'ul', 'ol', 'table', 'blockquote', 'pre', 'hr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'header', 'footer',
+))
+# Table cells are separated by a space so adjacent cells don't run together
+_HTML_CELL_TAGS = frozenset(('td', 'th'))
+_SPACES_RE = re.compile(r'[ \t\r\f\v\xa0]+')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n\s*\n+')
+
+# Only the first GMAIL_HTML_TEXT_MAX_CHARS of an HTML part are converted to text
+HTML_TEXT_MAX_CHARS = int(os.environ.get('GMAIL_HTML_TEXT_MAX_CHARS', '500000'))
+
+
+def _html_tag_to_text(match) -> str:
+    tag = match.group(3)
+    if not tag:
+        return ''
+    tag = tag.lower()
+    if tag in _HTML_BLOCK_TAGS:
+        return '\n'
+    return ' ' if tag in _HTML_CELL_TAGS else ''
+
+
+def _truncate_html(html_body: str, limit: int) -> str:
+    """Cut html_body to limit chars, dropping a tag cut in half and a trailing
+    comment, script or style left unclosed, so its content isn't read as text."""
+    # Work out where to cut first, so the body is copied only once
+    end = limit
+    cut = html_body.rfind('<', 0, end)
+    if cut > html_body.rfind('>', 0, end):
+        end = cut
+    # The last opener of each kind is the only one that can still be open
+    last = {}
+    for match in _HTML_HIDDEN_OPEN_RE.finditer(html_body, 0, end):
+        last[(match.group(1) or match.group(2)).lower()] = match.start()
+    for kind, start in sorted(last.items(), key=lambda item: -item[1]):
+        if start < end and not _HTML_HIDDEN_CLOSE_RE[kind].search(html_body, start, end):
+            end = start
+    return html_body[:end]
+
+
+def _html_to_text(html_body: str) -> str:
+    """Plain-text rendering of an HTML body: block elements become line
+    breaks, table cells spaces, entities are decoded and runs of whitespace
+    collapsed."""
+    if len(html_body) > HTML_TEXT_MAX_CHARS:
+        html_body = _truncate_html(html_body, HTML_TEXT_MAX_CHARS)
+    text = _HTML_TOKEN_RE.sub(_html_tag_to_text, html_body)
+    text = _SPACES_RE.sub(' ', html.unescape(text))
+    return _BLANK_LINES_RE.sub('\n\n', '\n'.join(line.strip() for line in text.split('\n'))).strip()
+
+
+def _decode_part(part: dict) -> str:
+    return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
+
+
 def _get_email_body(payload: dict) -> tuple:
     """Extract text and HTML body from a Gmail message payload.
-    Returns (text_body, html_body)."""
-    import re
-    text_body = ''
-    html_body = ''
-
-    if payload.get('mimeType') == 'text/plain' and payload.get('body', {}).get('data'):
-        text_body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='replace')
-    elif payload.get('mimeType') == 'text/html' and payload.get('body', {}).get('data'):
-        html_body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='replace')
-        text_body = re.sub(r'<br\s*/?>', '\n', html_body)
-        text_body = re.sub(r'<[^>]+>', '', text_body).strip()
-    elif payload.get('parts'):
-        for part in payload['parts']:
-            mime = part.get('mimeType', '')
-            if mime == 'text/plain' and part.get('body', {}).get('data'):
-                text_body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-            elif mime == 'text/html' and part.get('body', {}).get('data'):
-                html_body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
-            elif mime.startswith('multipart/') and part.get('parts'):
-                nested_text, nested_html = _get_email_body(part)
-                if nested_text and not text_body:
-                    text_body = nested_text
-                if nested_html and not html_body:
-                    html_body = nested_html
-
+    Returns (text_body, html_body).
+
+    Walks the MIME tree depth-first without recursion, keeps the first
+    text/plain and the first text/html part (attachments are skipped), decodes
+    each only once and stops as soon as both are found."""
+    text_body = None
+    html_body = None
+    stack = [payload]
+    while stack and (text_body is None or html_body is None):
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+            continue
+        if part.get('filename') or not part.get('body', {}).get('data'):
+            continue
+        mime = part.get('mimeType', '')
+        if mime == 'text/plain' and text_body is None:
+            text_body = _decode_part(part)
+        elif mime == 'text/html' and html_body is None:
+            html_body = _decode_part(part)
+
+    html_body = (html_body or '').strip()
+    if text_body is None:
         # If only HTML, derive text from it
-        if html_body and not text_body:
-            text_body = re.sub(r'<br\s*/?>', '\n', html_body)
-            text_body = re.sub(r'<[^>]+>', '', text_body).strip()
-
-    return (text_body.strip(), html_body.strip())
+        text_body = _html_to_text(html_body) if html_body else ''
+    return (text_body.strip(), html_body)
 
 
 def _parse_gmail_date(date_str: str) -> str:
@@ -139,8 +345,13 @@ def _gmail_msg_to_dict(msg: dict, user_email: str = '') -> dict:
     from_name, from_email_addr = _parse_name_email(headers.get('from', ''))
     to_name, to_email_addr = _parse_name_email(headers.get('to', ''))
 
+    # Metadata-format messages carry no body parts, only the snippet
+    body_loaded = 'parts' in msg.get('payload', {}) or 'data' in msg.get('payload', {}).get('body', {})
     body, body_html = _get_email_body(msg.get('payload', {}))
-    preview = body[:150].replace('\n', ' ').strip() if body else headers.get('subject', '')[:100]
+    if body:
+        preview = body[:150].replace('\n', ' ').strip()
+    else:
+        preview = html.unescape(msg.get('snippet', '')) or headers.get('subject', '')[:100]
 
     # Determine folder
     if 'SENT' in label_ids:
@@ -170,39 +381,84 @@ def _gmail_msg_to_dict(msg: dict, user_email: str = '') -> dict:
         'message_id': headers.get('message-id', ''),
         'in_reply_to': headers.get('in-reply-to', ''),
         'references': headers.get('references', ''),
+        'body_loaded': body_loaded,
     }
 
 
-def fetch_emails(folder: str = 'inbox', max_results: int = 50) -> list:
-    """Fetch real emails from Gmail."""
+def _batch_get_messages(service, msg_ids: list, msg_format: str = None,
+                        batch_size: int = None) -> list:
+    """Fetch many messages using Gmail batch requests.
+    Messages that fail with a rate limit or transient error are retried in a
+    later batch after a backoff. Returns the messages in the order of msg_ids,
+    skipping any that still failed."""
+    batch_size = batch_size or GMAIL_BATCH_SIZE
+    msg_format = msg_format or GMAIL_SYNC_FORMAT
+    extra = {'metadataHeaders': METADATA_HEADERS} if msg_format == 'metadata' else {}
+    # Building the resource walks the discovery document, so do it once
+    messages = service.users().messages()
+    results = {}
+    retry = {}
+
+    def _on_response(request_id, response, exception):
+        if exception is not None:
+            status = exception.resp.status if isinstance(exception, HttpError) else 'error'
+            gmail_batch_items.inc(status=str(status))
+            gmail_quota.record_error(exception)
+            if is_retryable(exception):
+                retry[request_id] = exception
+            else:
+                logger.error(f"Error fetching message {request_id}: {exception}")
+            return
+        gmail_batch_items.inc(status='ok')
+        results[request_id] = response
+
+    pending = list(msg_ids)
+    attempt = 0
+    while True:
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=_on_response)
+            for msg_id in chunk:
+                batch.add(messages.get(userId='me', id=msg_id, format=msg_format, **extra), request_id=msg_id)
+            _execute(batch, units=len(chunk) * quota_units('gmail.users.messages.get'))
+        if not retry:
+            break
+        if attempt >= gmail_quota.max_retries:
+            logger.error(f"Giving up on {len(retry)} messages after {attempt} retries: {next(iter(retry.values()))}")
+            break
+        pending = [msg_id for msg_id in msg_ids if msg_id in retry]
+        last_error = retry[pending[-1]]
+        retry.clear()
+        gmail_quota.sleep_before_retry(attempt, last_error)
+        attempt += 1
+
+    return [results[msg_id] for msg_id in msg_ids if msg_id in results]
+
+
+def fetch_emails(folder: str = 'inbox', max_results: int = 50, msg_format: str = None) -> list:
+    """Fetch real emails from Gmail.
+    msg_format defaults to GMAIL_SYNC_FORMAT ('metadata' or 'full')."""
     try:
         service = get_gmail_service()
-        profile = service.users().getProfile(userId='me').execute()
-        user_email = profile.get('emailAddress', '')
+        user_email = _get_profile(service).get('emailAddress', '')
 
         if folder == 'sent':
             query = 'in:sent'
         else:
             query = 'in:inbox'
 
-        results = service.users().messages().list(
+        results = _execute(service.users().messages().list(
             userId='me', q=query, maxResults=max_results
-        ).execute()
+        ))
 
-        messages = results.get('messages', [])
+        msg_ids = [msg_ref['id'] for msg_ref in results.get('messages', [])]
         emails = []
 
-        for msg_ref in messages:
-            try:
-                msg = service.users().messages().get(
-                    userId='me', id=msg_ref['id'], format='full'
-                ).execute()
-                email_dict = _gmail_msg_to_dict(msg, user_email)
-                email_dict['folder'] = folder
-                emails.append(email_dict)
-            except HttpError as e:
-                logger.error(f"Error fetching message {msg_ref['id']}: {e}")
-                continue
+        for msg in _batch_get_messages(service, msg_ids, msg_format):
+            _note_history_id(msg.get('historyId'))
+            email_dict = _gmail_msg_to_dict(msg, user_email)
+            email_dict['folder'] = folder
+            emails.append(email_dict)
 
         return emails
 
@@ -220,8 +476,7 @@ def send_gmail(to_email: str, subject: str, body: str,
     """Send a real email via Gmail API."""
     try:
         service = get_gmail_service()
-        profile = service.users().getProfile(userId='me').execute()
-        user_email = profile.get('emailAddress', '')
+        user_email = _get_profile(service).get('emailAddress', '')
 
         message = MIMEText(body)
         message['to'] = to_email
@@ -239,16 +494,17 @@ def send_gmail(to_email: str, subject: str, body: str,
         if thread_id:
             send_body['threadId'] = thread_id
 
-        sent = service.users().messages().send(
+        sent = _execute(service.users().messages().send(
             userId='me', body=send_body
-        ).execute()
+        ))
 
         logger.info(f"Email sent successfully. Message ID: {sent['id']}")
 
         # Fetch the full sent message to return details
-        full_msg = service.users().messages().get(
+        full_msg = _execute(service.users().messages().get(
             userId='me', id=sent['id'], format='full'
-        ).execute()
+        ))
+        _note_history_id(full_msg.get('historyId'))
 
         return _gmail_msg_to_dict(full_msg, user_email)
 
@@ -264,10 +520,10 @@ def mark_as_read_gmail(msg_id: str) -> bool:
     """Mark a Gmail message as read."""
     try:
         service = get_gmail_service()
-        service.users().messages().modify(
+        _execute(service.users().messages().modify(
             userId='me', id=msg_id,
             body={'removeLabelIds': ['UNREAD']}
-        ).execute()
+        ))
         return True
     except Exception as e:
         logger.error(f"Error marking as read: {e}")
@@ -282,25 +538,32 @@ def toggle_star_gmail(msg_id: str, add_star: bool) -> bool:
             body = {'addLabelIds': ['STARRED']}
         else:
             body = {'removeLabelIds': ['STARRED']}
-        service.users().messages().modify(
+        _execute(service.users().messages().modify(
             userId='me', id=msg_id, body=body
-        ).execute()
+        ))
         return True
     except Exception as e:
         logger.error(f"Error toggling star: {e}")
         return False
 
 
+def fetch_email_body(msg_id: str) -> tuple:
+    """Fetch one message in full and return its (text_body, html_body)."""
+    service = get_gmail_service()
+    msg = _execute(service.users().messages().get(userId='me', id=msg_id, format='full'))
+    return _get_email_body(msg.get('payload', {}))
+
+
 def fetch_thread(thread_id: str) -> list:
     """Fetch all messages in a Gmail thread."""
     try:
         service = get_gmail_service()
-        profile = service.users().getProfile(userId='me').execute()
-        user_email = profile.get('emailAddress', '')
+        user_email = _get_profile(service).get('emailAddress', '')
 
-        thread = service.users().threads().get(
+        thread = _execute(service.users().threads().get(
             userId='me', id=thread_id, format='full'
-        ).execute()
+        ))
+        _note_history_id(thread.get('historyId'))
 
         messages = []
         for msg in thread.get('messages', []):
@@ -311,53 +574,98 @@ def fetch_thread(thread_id: str) -> list:
 
     except Exception as e:
         logger.error(f"Error fetching thread: {e}")
-        return []
+        raise
+
+
+def _collect_history_changes(history: list) -> tuple:
+    """Fold history records into (added_ids, updates, deleted_ids).
+    updates maps message ID to changed fields, e.g. {'is_read': True}."""
+    added_ids = []
+    updates = {}
+    deleted_ids = set()
+
+    def _label_change(item, added: bool):
+        msg_id = item['message']['id']
+        labels = item.get('labelIds', [])
+        change = updates.setdefault(msg_id, {})
+        if 'UNREAD' in labels:
+            change['is_read'] = not added
+        if 'STARRED' in labels:
+            change['starred'] = added
+        if added and ('TRASH' in labels or 'SPAM' in labels):
+            deleted_ids.add(msg_id)
+        elif (added and 'INBOX' in labels) or (
+                not added and ('TRASH' in labels or 'SPAM' in labels)
+                and {'INBOX', 'SENT'} & set(item['message'].get('labelIds', []))):
+            # Moved back into the inbox, or restored from trash or spam into a
+            # synced folder; the upsert skips it if we already have it
+            if msg_id not in added_ids:
+                added_ids.append(msg_id)
+            deleted_ids.discard(msg_id)
+        elif not added and 'INBOX' in labels and 'SENT' not in item['message'].get('labelIds', []):
+            # Archived elsewhere, so it no longer belongs in any local folder
+            deleted_ids.add(msg_id)
+
+    for record in history:
+        for item in record.get('messagesAdded', []):
+            msg_id = item['message']['id']
+            if msg_id not in added_ids:
+                added_ids.append(msg_id)
+        for item in record.get('labelsAdded', []):
+            _label_change(item, added=True)
+        for item in record.get('labelsRemoved', []):
+            _label_change(item, added=False)
+        for item in record.get('messagesDeleted', []):
+            deleted_ids.add(item['message']['id'])
+
+    added_ids = [msg_id for msg_id in added_ids if msg_id not in deleted_ids]
+    updates = {msg_id: change for msg_id, change in updates.items()
+               if change and msg_id not in deleted_ids}
+    return added_ids, updates, deleted_ids
 
 
 def check_new_emails(history_id: str) -> tuple:
-    """Check for new emails since a given history ID.
-    Returns (new_emails_list, new_history_id)."""
+    """Check for changes since a given history ID, following every history page.
+    Returns (new_emails_list, new_history_id, changes) where changes is
+    {'updated': {gmail_id: {field: value}}, 'deleted': [gmail_id, ...]}.
+    Raises HistoryExpiredError if the history ID is too old and a full sync is needed."""
     try:
         service = get_gmail_service()
-        profile = service.users().getProfile(userId='me').execute()
-        user_email = profile.get('emailAddress', '')
-
-        results = service.users().history().list(
-            userId='me', startHistoryId=history_id,
-            historyTypes=['messageAdded'],
-            labelId='INBOX'
-        ).execute()
-
-        new_history_id = results.get('historyId', history_id)
-        history = results.get('history', [])
+        user_email = _get_profile(service).get('emailAddress', '')
+
+        history = []
+        new_history_id = history_id
+        page_token = None
+        while True:
+            results = _execute(service.users().history().list(
+                userId='me', startHistoryId=history_id,
+                historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                pageToken=page_token,
+            ))
+            history.extend(results.get('history', []))
+            new_history_id = results.get('historyId', new_history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+        _note_history_id(new_history_id)
+
+        msg_ids, updates, deleted_ids = _collect_history_changes(history)
 
         new_emails = []
-        seen_ids = set()
-
-        for record in history:
-            for msg_added in record.get('messagesAdded', []):
-                msg_id = msg_added['message']['id']
-                if msg_id not in seen_ids:
-                    seen_ids.add(msg_id)
-                    try:
-                        msg = service.users().messages().get(
-                            userId='me', id=msg_id, format='full'
-                        ).execute()
-                        if 'INBOX' in msg.get('labelIds', []):
-                            email_dict = _gmail_msg_to_dict(msg, user_email)
-                            email_dict['folder'] = 'inbox'
-                            new_emails.append(email_dict)
-                    except Exception:
-                        continue
-
-        return new_emails, new_history_id
+        for msg in _batch_get_messages(service, msg_ids):
+            label_ids = msg.get('labelIds', [])
+            if 'INBOX' in label_ids or 'SENT' in label_ids:
+                new_emails.append(_gmail_msg_to_dict(msg, user_email))
+
+        changes = {'updated': updates, 'deleted': sorted(deleted_ids)}
+        return new_emails, new_history_id, changes
 
     except HttpError as e:
         if e.resp.status == 404:
-            # History ID is too old, do a full sync
-            logger.warning("History ID expired, returning empty")
-            return [], history_id
+            # History ID is too old, caller has to do a full sync
+            logger.warning(f"History ID {history_id} expired")
+            raise HistoryExpiredError(history_id) from e
         raise
     except Exception as e:
         logger.error(f"Error checking new emails: {e}")
-        return [], history_id
+        raise
@@ -0,0 +1,353 @@
+"""
+Gmail HTTP Transport
+Pluggable httplib2-compatible transport under the Gmail API client, so sync
+can be exercised and benchmarked without a live account.
+
+    GMAIL_TRANSPORT=live      talk to Gmail (default)
+    GMAIL_TRANSPORT=record    talk to Gmail and save every response to GMAIL_FIXTURES_DIR
+    GMAIL_TRANSPORT=replay    serve responses from GMAIL_FIXTURES_DIR, no network or credentials
+
+Replay can add latency and inject faults:
+
+    GMAIL_TRANSPORT_LATENCY_MS=40       fixed, or "20-80" for uniform jitter
+    GMAIL_TRANSPORT_FAULTS=429:0.05,503:0.02,history_expired:1
+    GMAIL_TRANSPORT_SEED=1234           makes latency and faults reproducible
+
+Batch requests are split into their inner calls, which are recorded and
+replayed one by one, so fixtures do not depend on GMAIL_BATCH_SIZE.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from email.parser import FeedParser
+from http.client import responses as HTTP_REASONS
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import httplib2
+
+logger = logging.getLogger(__name__)
+
+GMAIL_API_ROOT = 'https://gmail.googleapis.com'
+
+# Query parameters that do not change the response
+_IGNORED_PARAMS = frozenset(('alt', 'prettyPrint'))
+
+_FAULT_ERRORS = {
+    429: ('RESOURCE_EXHAUSTED', 'rateLimitExceeded', 'Too many concurrent requests for user'),
+    500: ('INTERNAL', 'backendError', 'Backend Error'),
+    502: ('UNAVAILABLE', 'backendError', 'Bad Gateway'),
+    503: ('UNAVAILABLE', 'backendError', 'The service is currently unavailable.'),
+    504: ('DEADLINE_EXCEEDED', 'backendError', 'Deadline exceeded'),
+}
+
+
+class FixtureMissingError(LookupError):
+    """Raised by FixtureStore.get when no response was recorded for a request."""
+
+
+def request_key(method: str, uri: str) -> str:
+    """'GET /gmail/v1/users/me/messages?maxResults=50&q=in:inbox' with sorted,
+    normalised query parameters. Request bodies are not part of the key."""
+    parts = urlsplit(uri)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if k not in _IGNORED_PARAMS)
+    return f"{method.upper()} {parts.path}" + (f"?{urlencode(query)}" if query else '')
+
+
+def _error_body(status: int, message: str, reason: str = 'notFound', state: str = 'NOT_FOUND') -> bytes:
+    return json.dumps({'error': {
+        'code': status, 'message': message, 'status': state,
+        'errors': [{'message': message, 'domain': 'global', 'reason': reason}],
+    }}).encode()
+
+
+def _response(status: int, body: bytes, headers: dict = None) -> tuple:
+    resp = httplib2.Response({'status': str(status), 'content-type': 'application/json; charset=UTF-8',
+                              **(headers or {})})
+    return resp, body
+
+
+class FixtureStore:
+    """Recorded responses, one JSON file per request key in `directory`.
+
+    A key can hold several responses (e.g. history.list before and after new
+    mail); replay serves them in order and then keeps repeating the last one."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._served = {}
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{hashlib.sha1(key.encode()).hexdigest()[:20]}.json"
+
+    def _load(self, key: str) -> list:
+        if key not in self._cache:
+            path = self._path(key)
+            self._cache[key] = json.loads(path.read_text())['responses'] if path.exists() else []
+        return self._cache[key]
+
+    def add(self, method: str, uri: str, status: int, body, headers: dict = None):
+        """Append a response for a request and write it to disk."""
+        key = request_key(method, uri)
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', errors='replace')
+        entry = {'status': status, 'body': body}
+        if headers:
+            entry['headers'] = headers
+        with self._lock:
+            responses = self._load(key)
+            responses.append(entry)
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._path(key).write_text(json.dumps({'key': key, 'responses': responses}, indent=1))
+
+    def get(self, method: str, uri: str) -> dict:
+        """Next recorded response for a request."""
+        key = request_key(method, uri)
+        with self._lock:
+            responses = self._load(key)
+            if not responses:
+                raise FixtureMissingError(key)
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+            return responses[min(index, len(responses) - 1)]
+
+    def rewind(self):
+        """Serve every key from its first response again."""
+        with self._lock:
+            self._served.clear()
+
+
+# ── Batch requests ──────────────────────────────────────
+
+def _is_batch(uri: str) -> bool:
+    path = urlsplit(uri).path
+    return path == '/batch' or path.startswith('/batch/')
+
+
+def _multipart_parts(content_type: str, body) -> list:
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    parser = FeedParser()
+    parser.feed(f"content-type: {content_type}\r\n\r\n{body}")
+    return parser.close().get_payload()
+
+
+def _split_http_message(payload: str) -> tuple:
+    """'GET /path HTTP/1.1\\n<headers>\\n\\n<body>' -> (start_line, headers, body)."""
+    start_line, rest = payload.split('\n', 1)
+    parser = FeedParser()
+    parser.feed(rest)
+    message = parser.close()
+    return start_line.strip(), dict(message.items()), message.get_payload() or ''
+
+
+def _parse_batch_request(headers: dict, body) -> list:
+    """[(content_id, method, uri)] for the inner calls of a batch request."""
+    calls = []
+    for part in _multipart_parts(headers['content-type'], body):
+        start_line, _, _ = _split_http_message(part.get_payload())
+        method, path, _ = start_line.split(' ', 2)
+        calls.append((part['Content-ID'], method, GMAIL_API_ROOT + path))
+    return calls
+
+
+def _parse_batch_response(resp, content) -> dict:
+    """{request content_id: (status, body)} from a batch response."""
+    results = {}
+    for part in _multipart_parts(resp['content-type'], content):
+        start_line, _, body = _split_http_message(part.get_payload())
+        content_id = part['Content-ID'].replace('<response-', '<', 1)
+        results[content_id] = (int(start_line.split(' ', 2)[1]), body)
+    return results
+
+
+def _build_batch_response(parts: list) -> tuple:
+    """Assemble a multipart/mixed batch response from [(content_id, status, body)]."""
+    boundary = f"batch_{uuid.uuid4().hex}"
+    chunks = []
+    for content_id, status, body in parts:
+        chunks.append(
+            f"--{boundary}\r\nContent-Type: application/http\r\n"
+            f"Content-ID: <response-{content_id[1:]}\r\n\r\n"
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}\r\n"
+            f"Content-Type: application/json; charset=UTF-8\r\n\r\n"
+            f"{body.decode('utf-8') if isinstance(body, bytes) else body}\r\n"
+        )
+    chunks.append(f"--{boundary}--\r\n")
+    resp = httplib2.Response({'status': '200', 'content-type': f'multipart/mixed; boundary={boundary}'})
+    return resp, ''.join(chunks).encode('utf-8')
+
+
+# ── Transports ──────────────────────────────────────────
+
+class RecordingHttp:
+    """Forwards requests to a real (authorized) http object and records the
+    responses. Authorization is added by the inner object, so tokens never
+    reach the fixtures."""
+
+    def __init__(self, http, store: FixtureStore):
+        self.http = http
+        self.store = store
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        resp, content = self.http.request(uri, method=method, body=body, headers=headers,
+                                          redirections=redirections, connection_type=connection_type)
+        try:
+            if _is_batch(uri) and resp.status == 200:
+                results = _parse_batch_response(resp, content)
+                for content_id, inner_method, inner_uri in _parse_batch_request(headers, body):
+                    if content_id in results:
+                        self.store.add(inner_method, inner_uri, *results[content_id])
+            else:
+                extra = {'retry-after': resp['retry-after']} if 'retry-after' in resp else None
+                self.store.add(method, uri, resp.status, content, extra)
+        except Exception as e:
+            logger.error(f"Failed to record Gmail response for {method} {uri}: {e}")
+        return resp, content
+
+    def close(self):
+        close = getattr(self.http, 'close', None)
+        if close:
+            close()
+
+
+class FaultInjector:
+    """Random latency and error responses, reproducible for a given seed.
+
+    faults maps an HTTP status (429, 5xx) to the probability of answering a
+    request with it; 'history_expired' is the probability that history.list
+    answers 404 as if the start history ID were too old."""
+
+    def __init__(self, latency_ms=(0, 0), faults: dict = None, seed: int = None):
+        self.latency_ms = latency_ms
+        self.faults = faults or {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.injected = {}
+
+    @classmethod
+    def from_env(cls):
+        latency = os.environ.get('GMAIL_TRANSPORT_LATENCY_MS', '0')
+        low, _, high = latency.partition('-')
+        faults = {}
+        for item in filter(None, os.environ.get('GMAIL_TRANSPORT_FAULTS', '').split(',')):
+            name, _, rate = item.partition(':')
+            name = name.strip()
+            faults[int(name) if name.isdigit() else name] = float(rate or 1)
+        seed = os.environ.get('GMAIL_TRANSPORT_SEED')
+        return cls((float(low), float(high or low)), faults, int(seed) if seed else None)
+
+    def delay(self):
+        low, high = self.latency_ms
+        if high > 0:
+            with self._lock:
+                seconds = self._rng.uniform(low, high) / 1000
+            time.sleep(seconds)
+
+    def fault_for(self, method: str, uri: str):
+        """(status, body, headers) to answer instead of the fixture, or None."""
+        with self._lock:
+            for fault, rate in self.faults.items():
+                if fault == 'history_expired':
+                    if not urlsplit(uri).path.endswith('/history') or self._rng.random() >= rate:
+                        continue
+                    self.injected[fault] = self.injected.get(fault, 0) + 1
+                    return 404, _error_body(404, 'Requested entity was not found.'), None
+                if self._rng.random() < rate:
+                    self.injected[fault] = self.injected.get(fault, 0) + 1
+                    state, reason, message = _FAULT_ERRORS.get(fault, ('UNKNOWN', 'backendError', 'Injected error'))
+                    headers = {'retry-after': '1'} if fault == 429 else None
+                    return fault, _error_body(fault, message, reason, state), headers
+        return None
+
+
+class ReplayHttp:
+    """Serves Gmail API responses from a FixtureStore. Thread-safe, so one
+    instance is shared by every Gmail service in the process."""
+
+    def __init__(self, store: FixtureStore, faults: FaultInjector = None):
+        self.store = store
+        self.faults = faults or FaultInjector()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.missing = 0
+
+    def _serve(self, method: str, uri: str) -> tuple:
+        """(status, body, headers) for one (inner) request."""
+        with self._lock:
+            self.requests += 1
+        fault = self.faults.fault_for(method, uri)
+        if fault:
+            return fault
+        try:
+            entry = self.store.get(method, uri)
+        except FixtureMissingError as e:
+            with self._lock:
+                self.missing += 1
+            logger.warning(f"No Gmail fixture for {e}")
+            return 404, _error_body(404, f"No fixture for {e}"), None
+        return entry['status'], entry['body'].encode('utf-8'), entry.get('headers')
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        self.faults.delay()
+        if _is_batch(uri):
+            parts = []
+            for content_id, inner_method, inner_uri in _parse_batch_request(headers or {}, body):
+                status, content, _ = self._serve(inner_method, inner_uri)
+                parts.append((content_id, status, content))
+            return _build_batch_response(parts)
+        status, content, extra = self._serve(method, uri)
+        return _response(status, content, extra)
+
+    def close(self):
+        pass
+
+
+# ── Configuration ───────────────────────────────────────
+
+GMAIL_TRANSPORT = os.environ.get('GMAIL_TRANSPORT', 'live')
+GMAIL_FIXTURES_DIR = os.environ.get('GMAIL_FIXTURES_DIR', str(Path(__file__).parent / 'fixtures' / 'gmail'))
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def replaying() -> bool:
+    return GMAIL_TRANSPORT == 'replay'
+
+
+def _fixture_store() -> FixtureStore:
+    with _shared_lock:
+        if 'store' not in _shared:
+            _shared['store'] = FixtureStore(GMAIL_FIXTURES_DIR)
+        return _shared['store']
+
+
+def replay_http() -> ReplayHttp:
+    """The process-wide replay transport (created on first use)."""
+    store = _fixture_store()
+    with _shared_lock:
+        if 'replay' not in _shared:
+            _shared['replay'] = ReplayHttp(store, FaultInjector.from_env())
+        return _shared['replay']
+
+
+def build_http(credentials):
+    """http object for googleapiclient's build(), or None for the default live transport."""
+    if GMAIL_TRANSPORT == 'replay':
+        return replay_http()
+    if GMAIL_TRANSPORT == 'record':
+        import google_auth_httplib2
+        from googleapiclient.http import build_http as build_base_http
+        return RecordingHttp(google_auth_httplib2.AuthorizedHttp(credentials, http=build_base_http()),
+                             _fixture_store())
+    return None
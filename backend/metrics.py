@@ -0,0 +1,183 @@
+"""
+Metrics
+Minimal Prometheus-compatible counters, gauges and histograms, rendered in
+the text exposition format by render(). Updates are a dict lookup and a few
+additions under a lock, so they are cheap enough for the request path and
+safe to call from the Gmail worker threads.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+# Latency buckets in seconds, from fast Mongo lookups to slow Gemini replies
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    """Base class; counters and gauges can instead be read at scrape time from
+    a callback returning a single value (no labels)."""
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, '') for n in self.labelnames)
+
+    def _items(self) -> list:
+        if self.callback is not None:
+            try:
+                return [((), self.callback())]
+            except Exception:
+                return []
+        with self._lock:
+            return list(self._values.items())
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list:
+        return [f'{self.name}_total{_format_labels(self.labelnames, k)} {_format_value(v)}'
+                for k, v in self._items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self) -> list:
+        return [f'{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}' for k, v in self._items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non-cumulative) counts, sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block; labels may be changed inside it
+        (e.g. labels['outcome'] = 'error')."""
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list:
+        with self._lock:
+            items = [(k, (list(s[0]), s[1], s[2])) for k, s in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text format (version 0.0.4)."""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# ── Shared metrics ──────────────────────────────────────
+
+gmail_request_seconds = Histogram(
+    'gmail_api_request_duration_seconds', 'Gmail API call latency by API method.', ('method', 'status'))
+
+gmail_batch_items = Counter(
+    'gmail_api_batch_items', 'Calls inside Gmail batch requests by response status.', ('status',))
+
+mongo_command_seconds = Histogram(
+    'mongodb_command_duration_seconds', 'MongoDB command latency.', ('command', 'collection', 'outcome'))
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """pymongo command listener feeding mongodb_command_duration_seconds; pass
+    it to the client via event_listeners=[...]."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        self._collections[event.request_id] = target if isinstance(target, str) else ''
+
+    def succeeded(self, event):
+        self._finish(event, 'success')
+
+    def failed(self, event):
+        self._finish(event, 'error')
+
+    def _finish(self, event, outcome: str):
+        collection = self._collections.pop(event.request_id, '')
+        mongo_command_seconds.observe(event.duration_micros / 1e6, command=event.command_name,
+                                      collection=collection, outcome=outcome)
@@ -0,0 +1,186 @@
+"""
+Request Profiling
+Opt-in sampling profiler for single requests. A request carrying the admin
+token in an X-Profile header (or a __profile query parameter) is sampled
+from start to the last byte of its response. The samples are written as a
+collapsed-stack file for flamegraph.pl, speedscope or inferno.
+
+Stacks are rooted at one of:
+    event-loop   the event-loop thread while it runs Python code
+    waiting      the profiled request's await chain while the loop is idle
+    gmail-worker a gmail_executor thread running a call made for this request
+                 (see track_thread and run_gmail in server.py)
+
+The middleware is only installed when PROFILING_TOKEN is set, so requests
+pay nothing when profiling is off.
+"""
+
+import asyncio
+import contextvars
+import functools
+import hmac
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+PROFILE_DIR = Path(os.environ.get('PROFILE_DIR', str(Path(__file__).parent / 'profiles')))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5')) / 1000
+
+# Session of the request being profiled, visible to everything it awaits
+current_session = contextvars.ContextVar('profile_session', default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    path = Path(code.co_filename)
+    return f"{code.co_name} ({path.parent.name}/{path.name}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> list:
+    """Labels from the outermost frame to `frame`."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _await_stack(task) -> list:
+    """Labels along a suspended task's await chain, outermost first, ending
+    with what it is waiting on (e.g. the Future of a run_in_executor call)."""
+    labels = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, 'cr_frame', None) or getattr(awaitable, 'ag_frame', None) \
+            or getattr(awaitable, 'gi_frame', None)
+        if frame is None:
+            labels.append(f"await {type(awaitable).__name__}")
+            break
+        labels.append(_frame_label(frame))
+        awaitable = getattr(awaitable, 'cr_await', None) or getattr(awaitable, 'ag_await', None) \
+            or getattr(awaitable, 'gi_yieldfrom', None)
+    return labels
+
+
+def _is_idle(frame) -> bool:
+    """True when the event loop is blocked waiting in its selector."""
+    return frame.f_code.co_name in ('select', 'poll') and frame.f_code.co_filename.endswith('selectors.py')
+
+
+class ProfileSession:
+    """Background thread sampling the event loop and the request's worker threads."""
+
+    def __init__(self, task, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.task = task
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+        self._loop_thread = threading.get_ident()
+        self._workers = {}
+        self._workers_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+
+    def track_thread(self, func):
+        """Wrap a callable run on a worker thread so that thread is sampled while it runs."""
+        @functools.wraps(func)
+        def tracked(*args, **kwargs):
+            thread_id = threading.get_ident()
+            with self._workers_lock:
+                self._workers[thread_id] = self._workers.get(thread_id, 0) + 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._workers_lock:
+                    self._workers[thread_id] -= 1
+                    if not self._workers[thread_id]:
+                        del self._workers[thread_id]
+        return tracked
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            self.sample_count += 1
+            loop_frame = frames.get(self._loop_thread)
+            if loop_frame is not None:
+                if _is_idle(loop_frame):
+                    self.samples[';'.join(['waiting'] + _await_stack(self.task))] += 1
+                else:
+                    self.samples[';'.join(['event-loop'] + _stack(loop_frame))] += 1
+            with self._workers_lock:
+                workers = list(self._workers)
+            for thread_id in workers:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.samples[';'.join(['gmail-worker'] + _stack(frame))] += 1
+
+    def folded(self) -> str:
+        """Collapsed stacks: one "frame;frame;frame count" line per distinct stack."""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+def _profile_requested(scope) -> bool:
+    supplied = None
+    for name, value in scope['headers']:
+        if name == b'x-profile':
+            supplied = value.decode('latin-1')
+            break
+    if supplied is None and b'__profile=' in scope['query_string']:
+        supplied = parse_qs(scope['query_string'].decode('latin-1')).get('__profile', [''])[0]
+    # Compare bytes: compare_digest rejects non-ASCII str values with a TypeError
+    return bool(supplied) and hmac.compare_digest(supplied.encode(), PROFILING_TOKEN.encode())
+
+
+class RequestProfilerMiddleware:
+    """ASGI middleware profiling requests that carry the PROFILING_TOKEN. The
+    saved file's name is returned in the X-Profile-File response header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not _profile_requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', scope['path']).strip('_') or 'root'
+        filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:6]}-{scope['method']}-{slug}.folded"
+
+        async def send_with_header(message):
+            if message['type'] == 'http.response.start':
+                message = {**message, 'headers': [*message.get('headers', []),
+                                                  (b'x-profile-file', filename.encode())]}
+            await send(message)
+
+        session = ProfileSession(asyncio.current_task())
+        token = current_session.set(session)
+        session.start()
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            session.stop()
+            current_session.reset(token)
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            (PROFILE_DIR / filename).write_text(session.folded())
+            logger.info(f"Profiled {scope['method']} {scope['path']}: {session.duration:.3f}s, "
+                        f"{session.sample_count} samples -> {PROFILE_DIR / filename}")
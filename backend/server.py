@@ -1,20 +1,34 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Request
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, DeleteMany, IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import BulkWriteError, OperationFailure, CollectionInvalid
 import os
 import certifi
 import logging
 import json
+import re
+import base64
+import hashlib
+import hmac
+import random
+import time
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional
 import uuid
+from collections import OrderedDict, deque
 from datetime import datetime, timezone, timedelta
+import metrics
+import profiling
+from metrics import Counter, Gauge, Histogram
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -22,7 +36,9 @@ load_dotenv(ROOT_DIR / '.env')
 load_dotenv(ROOT_DIR.parent / '.env', override=True)
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url, tlsCAFile=certifi.where())
+client = AsyncIOMotorClient(
+    mongo_url, tlsCAFile=certifi.where(), event_listeners=[metrics.MongoCommandListener()]
+)
 db = client[os.environ['DB_NAME']]
 
 app = FastAPI()
@@ -68,11 +84,13 @@ class EmailSend(BaseModel):
 class ChatRequest(BaseModel):
     message: str
     context: dict = {}
+    session_id: str = ""
 
 
 class ChatMessage(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    session_id: str = ""
     role: str
     content: str
     actions: list = []
@@ -82,45 +100,255 @@ class ChatMessage(BaseModel):
 # ── WebSocket Manager ───────────────────────────────────
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    """Fans events out to WebSocket clients.
+
+    Each connection gets a bounded send queue drained by its own task, so one
+    slow client cannot hold up the others. Broadcasts yield to the event loop
+    after queueing, so a burst of events only overflows the queues of clients
+    that are not keeping up; those are disconnected.
+
+    Broadcast events carry a per-stream sequence number and are kept in a
+    ring buffer (optionally mirrored to a capped Mongo collection), so a
+    reconnecting client can pass its stream and last seq and only receive the
+    events it missed."""
+
+    def __init__(self, queue_size: int = 100, replay_size: int = 500, event_store=None):
+        self.queue_size = queue_size
+        self.active_connections: dict[WebSocket, asyncio.Queue] = {}
+        self._senders: dict[WebSocket, asyncio.Task] = {}
+        self.dropped_clients = 0
+        self.messages_broadcast = 0
+        self.stream_id = str(uuid.uuid4())
+        self.seq = 0
+        self.replay_buffer = deque(maxlen=replay_size)  # (seq, serialized event)
+        self.event_store = event_store
+
+    async def load_events(self):
+        """Restore the stream ID, sequence and replay buffer from the event store."""
+        if self.event_store is None:
+            return
+        try:
+            await self.event_store.database.create_collection(
+                self.event_store.name, capped=True,
+                size=max(1024 * 1024, self.replay_buffer.maxlen * 4096), max=self.replay_buffer.maxlen,
+            )
+        except CollectionInvalid:
+            pass  # already exists
+        docs = await self.event_store.find({}, {"_id": 0}).sort("$natural", -1).to_list(self.replay_buffer.maxlen)
+        if docs:
+            self.stream_id = docs[0]['stream']
+            self.seq = docs[0]['seq']
+            self.replay_buffer.extend(
+                (doc['seq'], doc['text']) for doc in reversed(docs) if doc['stream'] == self.stream_id
+            )
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, last_seq: int = None, stream: str = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.active_connections[websocket] = queue
+        self._senders[websocket] = asyncio.create_task(self._drain(websocket, queue))
+        # No awaits from here on, so no live event can slip in ahead of the replay
+        hello = {"type": "hello", "stream": self.stream_id, "seq": self.seq}
+        self._enqueue(websocket, queue, json.dumps(hello, separators=(",", ":")))
+        if last_seq is not None:
+            self._replay(websocket, queue, last_seq, stream)
+
+    def _replay(self, websocket: WebSocket, queue: asyncio.Queue, last_seq: int, stream: str):
+        missed = [(seq, text) for seq, text in self.replay_buffer if seq > last_seq]
+        oldest = self.replay_buffer[0][0] if self.replay_buffer else self.seq + 1
+        gap_lost = last_seq < oldest - 1 and last_seq < self.seq
+        if stream != self.stream_id or last_seq > self.seq or gap_lost or len(missed) >= self.queue_size - 1:
+            # Too old, from another stream, or too much to replay: client must reload
+            message = {"type": "resync_required", "stream": self.stream_id, "seq": self.seq}
+            self._enqueue(websocket, queue, json.dumps(message, separators=(",", ":")))
+            return
+        for _, text in missed:
+            self._enqueue(websocket, queue, text)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+        sender = self._senders.pop(websocket, None)
+        if sender and sender is not asyncio.current_task():
+            sender.cancel()
+
+    async def _drain(self, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True:
+                await websocket.send_text(await queue.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(websocket)
+
+    async def _close_quietly(self, websocket: WebSocket):
+        try:
+            # 1013 = try again later; the frontend reconnects on close
+            await asyncio.wait_for(websocket.close(code=1013), timeout=5)
+        except Exception:
+            pass
+
+    def _enqueue(self, websocket: WebSocket, queue: asyncio.Queue, text: str):
+        try:
+            queue.put_nowait(text)
+        except asyncio.QueueFull:
+            logger.warning("WebSocket client too slow, dropping it")
+            self.dropped_clients += 1
+            self.disconnect(websocket)
+            asyncio.create_task(self._close_quietly(websocket))
+
+    async def send(self, websocket: WebSocket, message: dict):
+        """Queue a message for a single client."""
+        queue = self.active_connections.get(websocket)
+        if queue is not None:
+            self._enqueue(websocket, queue, json.dumps(message, separators=(",", ":"), ensure_ascii=False))
 
     async def broadcast(self, message: dict):
-        disconnected = []
-        for conn in self.active_connections:
+        self.seq += 1
+        seq = self.seq
+        # Serialize once, then hand the same text to every connection's queue
+        text = json.dumps({**message, "seq": seq}, separators=(",", ":"), ensure_ascii=False)
+        self.replay_buffer.append((seq, text))
+        self.messages_broadcast += 1
+        for conn, queue in list(self.active_connections.items()):
+            self._enqueue(conn, queue, text)
+        if self.event_store is not None:
             try:
-                await conn.send_json(message)
-            except Exception:
-                disconnected.append(conn)
-        for conn in disconnected:
-            self.disconnect(conn)
+                await self.event_store.insert_one({"stream": self.stream_id, "seq": seq, "text": text})
+            except Exception as e:
+                logger.error(f"Failed to persist WebSocket event {seq}: {e}")
+        # Let the send tasks run before the next event is queued
+        await asyncio.sleep(0)
+
+    def stats(self) -> dict:
+        depths = [queue.qsize() for queue in self.active_connections.values()]
+        return {
+            "connections": len(depths),
+            "queue_size": self.queue_size,
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "dropped_clients": self.dropped_clients,
+            "messages_broadcast": self.messages_broadcast,
+            "stream": self.stream_id,
+            "seq": self.seq,
+            "replay_buffered": len(self.replay_buffer),
+        }
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    queue_size=int(os.environ.get('WS_SEND_QUEUE_SIZE', '100')),
+    replay_size=int(os.environ.get('WS_REPLAY_BUFFER_SIZE', '500')),
+    # Set WS_PERSIST_EVENTS=1 to keep the replay buffer across restarts
+    event_store=db.ws_events if os.environ.get('WS_PERSIST_EVENTS') == '1' else None,
+)
+
+
+# ── Blocking I/O ────────────────────────────────────────
+
+# The Gmail client is synchronous, so its calls run on a bounded worker pool
+# instead of stalling the event loop. AI calls use the native async client and
+# are capped by a semaphore.
+GMAIL_MAX_WORKERS = int(os.environ.get('GMAIL_MAX_WORKERS', '4'))
+AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', '4'))
+
+gmail_executor = ThreadPoolExecutor(max_workers=GMAIL_MAX_WORKERS, thread_name_prefix='gmail')
+ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+
+async def run_gmail(func, *args, **kwargs):
+    """Run a blocking Gmail call on the worker pool and await its result."""
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    session = profiling.current_session.get()
+    if session is not None:
+        # Sample the worker thread too while a profiled request waits on it
+        call = session.track_thread(call)
+    return await loop.run_in_executor(gmail_executor, call)
+
+
+# ── Metrics ─────────────────────────────────────────────
+
+# Served at GET /metrics in the Prometheus text format. Gmail API calls are
+# timed in gmail_service and Mongo commands by the client's command listener.
+http_request_seconds = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route template.', ('method', 'route', 'status'))
+ai_request_seconds = Histogram(
+    'ai_request_duration_seconds', 'Gemini request latency; streamed replies until the last chunk.',
+    ('mode', 'outcome'))
+ai_first_chunk_seconds = Histogram(
+    'ai_stream_first_chunk_seconds', 'Time until the first chunk of a streamed Gemini reply.')
+poll_seconds = Histogram('gmail_poll_duration_seconds', 'Duration of a Gmail poll cycle.', ('outcome',))
+poll_lag = Gauge('gmail_poll_lag_seconds', 'How late the last Gmail poll started compared to its schedule.')
+messages_synced_last_cycle = Gauge(
+    'gmail_messages_synced_last_cycle', 'New emails stored by the last sync cycle.', ('mode',))
+messages_synced = Counter('gmail_messages_synced', 'New emails stored by sync cycles.', ('mode',))
+Gauge('websocket_connections', 'Connected WebSocket clients.',
+      callback=lambda: len(manager.active_connections))
+Gauge('websocket_send_queue_depth', 'Events waiting in WebSocket send queues.',
+      callback=lambda: sum(queue.qsize() for queue in manager.active_connections.values()))
+Counter('websocket_dropped_clients', 'WebSocket clients disconnected for falling behind.',
+        callback=lambda: manager.dropped_clients)
+Counter('gmail_api_retries', 'Gmail API calls and batch items retried after an error.',
+        callback=lambda: gmail_quota.counters['retries'])
+Counter('gmail_api_rate_limited', 'Gmail API responses rejected for rate limits.',
+        callback=lambda: gmail_quota.counters['rate_limited'])
+Counter('gmail_api_throttled_seconds', 'Time Gmail calls waited for quota units.',
+        callback=lambda: gmail_quota.counters['throttled_seconds'])
+
+
+def record_synced(mode: str, count: int):
+    messages_synced_last_cycle.set(count, mode=mode)
+    messages_synced.inc(count, mode=mode)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing HTTP requests by route template, so /emails/{email_id}
+    is one series. Streaming responses are timed until their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get('route'), 'path', None) or 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - start, method=scope['method'],
+                                         route=route, status=str(status[0]))
 
 
 # ── Gmail Integration ───────────────────────────────────
 
+from email_index import EmailIndex
 from gmail_service import (
-    is_gmail_configured, get_gmail_service, get_user_profile,
+    is_gmail_configured, invalidate_gmail_service, get_user_profile,
     fetch_emails as gmail_fetch_emails, send_gmail,
     mark_as_read_gmail, toggle_star_gmail, fetch_thread,
-    check_new_emails,
+    check_new_emails, HistoryExpiredError, fetch_email_body, require_user_profile,
 )
+from gmail_quota import gmail_quota
 from google_auth_oauthlib.flow import Flow
 
 # Track Gmail history ID for real-time polling
 gmail_history_id = None
 user_profile_cache = None
 
+# In-process BM25 index used to pick the emails sent to the AI assistant
+email_index = EmailIndex()
+
+# Persisted sync checkpoint (db.sync_state) so restarts only apply history deltas
+SYNC_STATE_ID = 'gmail_sync'
+
 # OAuth scopes
 OAUTH_SCOPES = [
     'https://www.googleapis.com/auth/gmail.readonly',
@@ -136,10 +364,84 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'change-me-in-production')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRY_DAYS = 7
 
+# ── MongoDB Indexes ─────────────────────────────────────
+
+# Declared indexes per collection; ensure_indexes() reconciles them at startup
+MONGO_INDEXES = {
+    'emails': [
+        # Simulated (non-Gmail) sends have an empty gmail_id, so keep them out
+        IndexModel([('gmail_id', ASCENDING)], name='gmail_id_unique', unique=True,
+                   partialFilterExpression={'gmail_id': {'$gt': ''}}),
+        IndexModel([('id', ASCENDING)], name='id'),
+        IndexModel([('folder', ASCENDING), ('date', DESCENDING), ('id', DESCENDING)], name='folder_date'),
+        IndexModel([('thread_id', ASCENDING), ('date', ASCENDING)], name='thread_date'),
+        # Keyword search with relevance ranking (GET /api/emails)
+        # preview holds the Gmail snippet for messages whose body is not loaded yet
+        IndexModel([('subject', TEXT), ('body', TEXT), ('preview', TEXT), ('from_name', TEXT), ('from_email', TEXT)],
+                   name='email_text',
+                   weights={'subject': 10, 'from_name': 5, 'from_email': 5, 'preview': 2, 'body': 1}),
+    ],
+    'jwt_blacklist': [
+        IndexModel([('token', ASCENDING)], name='token_unique', unique=True),
+        # Tokens expire on their own after JWT_EXPIRY_DAYS, so the entry can go too
+        IndexModel([('blacklisted_at', ASCENDING)], name='blacklisted_at_ttl',
+                   expireAfterSeconds=JWT_EXPIRY_DAYS * 24 * 3600),
+    ],
+    'chat_messages': [
+        # Last-N window per chat session (see get_conversation)
+        IndexModel([('session_id', ASCENDING), ('timestamp', DESCENDING)], name='session_timestamp'),
+    ],
+}
+
+_INDEX_OPTIONS = ('unique', 'expireAfterSeconds', 'partialFilterExpression', 'weights')
+
+
+def _index_matches(existing: dict, spec: dict) -> bool:
+    """Compare an index_information() entry with a declared IndexModel document."""
+    spec_key = list(spec['key'].items())
+    if all(direction == TEXT for _, direction in spec_key):
+        # Text indexes are stored under _fts/_ftsx; their fields live in 'weights'
+        spec_key = [('_fts', 'text'), ('_ftsx', 1)]
+    if list(existing.get('key', [])) != spec_key:
+        return False
+    return all(existing.get(opt) == spec.get(opt) for opt in _INDEX_OPTIONS)
+
+
+async def ensure_indexes():
+    """Create missing indexes and rebuild ones whose definition changed."""
+    for collection_name, models in MONGO_INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        for model in models:
+            spec = model.document
+            name = spec['name']
+            if name in existing and _index_matches(existing[name], spec):
+                continue
+            try:
+                if name in existing:
+                    logger.info(f"Index {collection_name}.{name} changed, dropping it")
+                    await collection.drop_index(name)
+                await collection.create_indexes([model])
+                logger.info(f"Built index {collection_name}.{name}")
+            except OperationFailure as e:
+                logger.error(f"Failed to build index {collection_name}.{name}: {e}")
+
+
 # ── JWT Auth Helpers ────────────────────────────────────
 
 security = HTTPBearer(auto_error=False)
 
+# Verified tokens are cached by hash so authenticated requests skip both the
+# signature check and the database. Revocations are mirrored locally: logout
+# adds to it directly and refresh_revoked_tokens() merges in Mongo's entries.
+# Entries are only dropped once the token itself has expired.
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', '1024'))
+JWT_CACHE_TTL = int(os.environ.get('JWT_CACHE_TTL', '300'))
+JWT_REVOCATION_REFRESH_SECONDS = int(os.environ.get('JWT_REVOCATION_REFRESH_SECONDS', '60'))
+
+jwt_verify_cache = OrderedDict()  # token hash -> (email, cache expiry as epoch seconds)
+revoked_token_hashes = {}  # token hash -> token expiry as epoch seconds
+
 
 def create_jwt_token(email: str) -> str:
     """Create a JWT token for the given user email."""
@@ -151,19 +453,75 @@ def create_jwt_token(email: str) -> str:
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _token_expiry(token: str) -> float:
+    """The token's exp claim, or the longest lifetime we issue if it can't be read."""
+    try:
+        payload = jwt.decode(token, options={'verify_signature': False, 'verify_exp': False})
+        return float(payload['exp'])
+    except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+        return time.time() + JWT_EXPIRY_DAYS * 24 * 3600
+
+
+def revoke_token(token: str):
+    """Mark a token as revoked in the local revocation set and verify cache."""
+    token_hash = _token_hash(token)
+    revoked_token_hashes[token_hash] = _token_expiry(token)
+    jwt_verify_cache.pop(token_hash, None)
+
+
+async def load_revoked_tokens():
+    """Merge db.jwt_blacklist into the local revocation set and prune expired tokens.
+    Entries are never removed because Mongo lacks them, so a logout whose
+    write is still in flight (or failed) stays revoked."""
+    docs = await db.jwt_blacklist.find({}, {'_id': 0, 'token': 1, 'token_hash': 1}).to_list(None)
+    for doc in docs:
+        token = doc.get('token', '')
+        token_hash = doc.get('token_hash') or _token_hash(token)
+        if token_hash not in revoked_token_hashes:
+            revoked_token_hashes[token_hash] = _token_expiry(token)
+            jwt_verify_cache.pop(token_hash, None)
+    # Expired tokens fail signature verification anyway
+    now = time.time()
+    for token_hash in [h for h, expires in revoked_token_hashes.items() if expires < now]:
+        del revoked_token_hashes[token_hash]
+
+
+async def refresh_revoked_tokens():
+    """Background task that picks up revocations made by other processes."""
+    while True:
+        await asyncio.sleep(JWT_REVOCATION_REFRESH_SECONDS)
+        try:
+            await load_revoked_tokens()
+        except Exception as e:
+            logger.error(f"Failed to refresh revoked tokens: {e}")
+
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
     """FastAPI dependency: validate JWT and return user email."""
     if not credentials:
         raise HTTPException(status_code=401, detail='Not authenticated')
+    token_hash = _token_hash(credentials.credentials)
+    if token_hash in revoked_token_hashes:
+        raise HTTPException(status_code=401, detail='Token has been revoked')
+    cached = jwt_verify_cache.get(token_hash)
+    if cached and cached[1] > time.time():
+        jwt_verify_cache.move_to_end(token_hash)
+        return cached[0]
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         email = payload.get('email')
         if not email:
             raise HTTPException(status_code=401, detail='Invalid token')
-        # Check if token is blacklisted
-        blacklisted = await db.jwt_blacklist.find_one({'token': credentials.credentials})
-        if blacklisted:
-            raise HTTPException(status_code=401, detail='Token has been revoked')
+        # Never cache past the token's own expiry
+        cache_until = min(time.time() + JWT_CACHE_TTL, payload.get('exp', 0))
+        jwt_verify_cache[token_hash] = (email, cache_until)
+        jwt_verify_cache.move_to_end(token_hash)
+        while len(jwt_verify_cache) > JWT_CACHE_SIZE:
+            jwt_verify_cache.popitem(last=False)
         return email
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail='Token has expired')
@@ -198,6 +556,7 @@ async def load_tokens_from_db():
     doc = await db.auth_tokens.find_one({'_id': 'gmail_tokens'})
     if doc:
         os.environ['GMAIL_REFRESH_TOKEN'] = doc.get('refresh_token', '')
+        invalidate_gmail_service()
     return doc
 
 
@@ -209,94 +568,462 @@ async def store_tokens_to_db(refresh_token: str, email: str):
         upsert=True,
     )
     os.environ['GMAIL_REFRESH_TOKEN'] = refresh_token
+    invalidate_gmail_service()
 
 
-async def sync_gmail_to_db(folder: str = 'inbox', max_results: int = 50):
-    """Sync Gmail emails to MongoDB for fast access."""
-    global gmail_history_id
+async def upsert_emails(emails: list) -> list:
+    """Upsert emails keyed on gmail_id with a single unordered bulk write.
+    Returns the emails that were not in the DB before."""
+    if not emails:
+        return []
+    ops = [
+        UpdateOne(
+            {"gmail_id": email_data['gmail_id']},
+            {
+                "$set": {"is_read": email_data['is_read'], "starred": email_data['starred']},
+                "$setOnInsert": {k: v for k, v in email_data.items() if k not in ("is_read", "starred")},
+            },
+            upsert=True,
+        )
+        for email_data in emails
+    ]
     try:
-        emails = gmail_fetch_emails(folder=folder, max_results=max_results)
-        if not emails:
-            return 0
-
-        count = 0
-        for email_data in emails:
-            # Upsert by gmail_id to avoid duplicates
-            existing = await db.emails.find_one({"gmail_id": email_data['gmail_id']})
-            if existing:
-                # Update read/starred status
-                await db.emails.update_one(
-                    {"gmail_id": email_data['gmail_id']},
-                    {"$set": {
-                        "is_read": email_data['is_read'],
-                        "starred": email_data['starred'],
-                    }}
-                )
+        result = await db.emails.bulk_write(ops, ordered=False)
+        upserted = result.upserted_ids
+    except BulkWriteError as e:
+        logger.error(f"Bulk email upsert partially failed: {e.details.get('writeErrors', [])[:3]}")
+        upserted = {u['index']: u['_id'] for u in e.details.get('upserted', [])}
+    invalidate_ai_context()
+    for i, email_data in enumerate(emails):
+        if i in upserted:
+            email_index.add(email_data)
+        else:
+            email_index.update(email_data['id'], email_data)
+    return [emails[i] for i in sorted(upserted)]
+
+
+async def load_sync_checkpoint():
+    """Load the persisted Gmail sync checkpoint, if any."""
+    return await db.sync_state.find_one({'_id': SYNC_STATE_ID})
+
+
+async def save_sync_checkpoint(history_id: str, emails: list = None, account: str = None):
+    """Persist the latest history ID plus a per-folder watermark for the given emails."""
+    now = datetime.now(timezone.utc).isoformat()
+    update = {'$set': {'history_id': history_id, 'updated_at': now}}
+    if account is not None:
+        update['$set']['email'] = account
+    latest = {}
+    for email_data in emails or []:
+        folder = email_data.get('folder', 'inbox')
+        latest[folder] = max(latest.get(folder, ''), email_data.get('date', ''))
+    for folder, date in latest.items():
+        update['$set'][f'folders.{folder}.synced_at'] = now
+        update.setdefault('$max', {})[f'folders.{folder}.latest_date'] = date
+    await db.sync_state.update_one({'_id': SYNC_STATE_ID}, update, upsert=True)
+
+
+async def full_resync() -> dict:
+    """Replace the local store with the latest inbox and sent emails.
+    Everything is fetched before anything is deleted, so a failed fetch
+    leaves the store and checkpoint as they were."""
+    global gmail_history_id
+    # Take the history ID before fetching so nothing that arrives mid-sync is missed
+    profile = await run_gmail(require_user_profile)
+    start_history_id = profile.get('history_id')
+    fetched = {}
+    for folder, max_results in (('inbox', 50), ('sent', 30)):
+        fetched[folder] = await run_gmail(gmail_fetch_emails, folder=folder, max_results=max_results)
+
+    await db.emails.delete_many({})
+    await db.sync_state.delete_many({})
+    email_body_cache.clear()
+    email_index.clear()
+    invalidate_ai_context()
+    counts = {}
+    synced = []
+    for folder, emails in fetched.items():
+        counts[folder] = len(await upsert_emails(emails))
+        synced.extend(emails)
+        logger.info(f"Synced {counts[folder]} new emails from Gmail ({folder})")
+    record_synced('full', sum(counts.values()))
+
+    if start_history_id:
+        gmail_history_id = start_history_id
+        await save_sync_checkpoint(start_history_id, synced, account=profile['email'])
+    return {**counts, 'mode': 'full'}
+
+
+async def apply_history_delta(history_id: str) -> list:
+    """Apply Gmail history since history_id to the DB, broadcast and checkpoint it.
+    Returns the newly inserted emails. Raises HistoryExpiredError if too old."""
+    global gmail_history_id
+    new_emails, new_history_id, changes = await run_gmail(check_new_emails, history_id)
+    inserted = await upsert_emails(new_emails)
+
+    # Read/star changes and deletions made in other Gmail clients, in one batch
+    ops = [UpdateOne({"gmail_id": gmail_id}, {"$set": fields})
+           for gmail_id, fields in changes['updated'].items()]
+    if changes['deleted']:
+        ops.append(DeleteMany({"gmail_id": {"$in": changes['deleted']}}))
+    if ops:
+        await db.emails.bulk_write(ops, ordered=False)
+        invalidate_ai_context()
+    for gmail_id, fields in changes['updated'].items():
+        email_index.update(gmail_id, fields)
+    for gmail_id in changes['deleted']:
+        email_body_cache.pop(gmail_id, None)
+        email_index.remove(gmail_id)
+
+    gmail_history_id = new_history_id
+    await save_sync_checkpoint(new_history_id, inserted)
+
+    for email_data in inserted:
+        safe_doc = {k: v for k, v in email_data.items() if k != "_id"}
+        if email_data.get('folder') == 'sent':
+            await manager.broadcast({"type": "email_sent", "email": safe_doc})
+        else:
+            await manager.broadcast({"type": "new_email", "email": safe_doc})
+            logger.info(f"New Gmail email from {email_data.get('from_name', 'Unknown')}")
+    if changes['updated']:
+        # One event per poll however many messages changed, e.g. a bulk mark-as-read
+        await manager.broadcast({"type": "emails_updated", "changes": changes['updated']})
+    if changes['deleted']:
+        await manager.broadcast({"type": "email_deleted", "ids": changes['deleted']})
+    return inserted
+
+
+async def resync_gmail() -> dict:
+    """Bring the local store up to date from the persisted checkpoint.
+    Falls back to a full resync when there is no checkpoint, it belongs to
+    another account, or Gmail reports its history ID as expired. Raises if
+    Gmail can't be reached."""
+    checkpoint = await load_sync_checkpoint()
+    if not checkpoint or not checkpoint.get('history_id'):
+        return await full_resync()
+    # Raises if Gmail can't be reached, rather than mistaking that for another account
+    profile = await run_gmail(require_user_profile)
+    if checkpoint.get('email') != profile['email']:
+        logger.warning(f"Sync checkpoint belongs to {checkpoint.get('email') or 'an unknown account'}, running full resync")
+    else:
+        try:
+            inserted = await apply_history_delta(checkpoint['history_id'])
+            counts = {'inbox': 0, 'sent': 0}
+            for email_data in inserted:
+                counts[email_data.get('folder', 'inbox')] += 1
+            logger.info(f"Incremental Gmail sync from history {checkpoint['history_id']}: {counts}")
+            return {**counts, 'mode': 'incremental'}
+        except HistoryExpiredError:
+            logger.warning("Sync checkpoint expired, running full resync")
+    return await full_resync()
+
+
+class PollScheduler:
+    """Adaptive interval for the Gmail poll loop.
+
+    Polls at min_interval while WebSocket clients are connected or mail arrived
+    recently, doubles the interval (up to max_interval) while idle or after
+    errors, and spreads every delay by +/- jitter."""
+
+    def __init__(self, min_interval: float, max_interval: float, jitter: float, active_window: float):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.active_window = active_window
+        self.interval = min_interval
+        self.consecutive_errors = 0
+        self.last_poll_at = None
+        self.last_new_mail_at = None
+        self.next_poll_at = None
+        self._wake = asyncio.Event()
+
+    def record_poll(self, new_count: int = 0, error: bool = False, clients: int = 0) -> float:
+        """Update state after a poll and return the jittered delay until the next one."""
+        now = time.time()
+        self.last_poll_at = now
+        if new_count:
+            self.last_new_mail_at = now
+        if error:
+            self.consecutive_errors += 1
+            self.interval = min(self.max_interval, self.interval * 2)
+        else:
+            self.consecutive_errors = 0
+            recent_mail = self.last_new_mail_at and now - self.last_new_mail_at < self.active_window
+            if clients or recent_mail:
+                self.interval = self.min_interval
             else:
-                await db.emails.insert_one(email_data)
-                count += 1
+                self.interval = min(self.max_interval, self.interval * 2)
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.next_poll_at = now + delay
+        return delay
+
+    def wake(self):
+        """Cut the current sleep short, e.g. when a client connects (not while backing off errors)."""
+        if self.consecutive_errors == 0:
+            self._wake.set()
+
+    async def sleep(self, delay: float):
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def status(self) -> dict:
+        def iso(ts):
+            return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+        return {
+            "interval_seconds": round(self.interval, 2),
+            "min_interval_seconds": self.min_interval,
+            "max_interval_seconds": self.max_interval,
+            "consecutive_errors": self.consecutive_errors,
+            "last_poll_at": iso(self.last_poll_at),
+            "next_poll_at": iso(self.next_poll_at),
+            "last_new_mail_at": iso(self.last_new_mail_at),
+        }
 
-        # Get the latest history ID for polling
-        service = get_gmail_service()
-        profile = service.users().getProfile(userId='me').execute()
-        gmail_history_id = profile.get('historyId')
 
-        logger.info(f"Synced {count} new emails from Gmail ({folder})")
-        return count
-    except Exception as e:
-        logger.error(f"Gmail sync error: {e}")
-        return 0
+poll_scheduler = PollScheduler(
+    min_interval=float(os.environ.get('GMAIL_POLL_MIN_INTERVAL', '10')),
+    max_interval=float(os.environ.get('GMAIL_POLL_MAX_INTERVAL', '300')),
+    jitter=float(os.environ.get('GMAIL_POLL_JITTER', '0.2')),
+    active_window=float(os.environ.get('GMAIL_POLL_ACTIVE_WINDOW', '120')),
+)
+poll_task = None
 
 
-async def poll_gmail_for_new_emails():
-    """Background task that polls Gmail for new emails every 30 seconds."""
-    global gmail_history_id
+def start_polling():
+    """Start the Gmail poll loop unless it is already running."""
+    global poll_task
+    if poll_task is None or poll_task.done():
+        poll_task = asyncio.create_task(poll_gmail_for_new_emails())
 
+
+async def poll_gmail_for_new_emails():
+    """Background task that polls Gmail for new emails on an adaptive schedule."""
     # Wait a bit before starting polling
     await asyncio.sleep(10)
 
     while True:
-        try:
-            if gmail_history_id and is_gmail_configured():
-                new_emails, new_history_id = check_new_emails(gmail_history_id)
-                gmail_history_id = new_history_id
-
-                for email_data in new_emails:
-                    # Check if already in DB
-                    existing = await db.emails.find_one({"gmail_id": email_data['gmail_id']})
-                    if not existing:
-                        await db.emails.insert_one(email_data)
-                        safe_doc = {k: v for k, v in email_data.items() if k != "_id"}
-                        await manager.broadcast({"type": "new_email", "email": safe_doc})
-                        logger.info(f"New Gmail email from {email_data.get('from_name', 'Unknown')}")
-        except Exception as e:
-            logger.error(f"Gmail polling error: {e}")
-
-        await asyncio.sleep(30)  # Poll every 30 seconds
-
-
-# ── AI Assistant ────────────────────────────────────────
+        if poll_scheduler.next_poll_at:
+            poll_lag.set(max(0.0, time.time() - poll_scheduler.next_poll_at))
+        new_count, error = 0, False
+        with poll_seconds.time(outcome='success') as labels:
+            try:
+                if gmail_history_id and is_gmail_configured():
+                    try:
+                        new_count = len(await apply_history_delta(gmail_history_id))
+                        record_synced('delta', new_count)
+                    except HistoryExpiredError:
+                        logger.warning("Polling history ID expired, running full resync")
+                        await full_resync()
+            except Exception as e:
+                logger.error(f"Gmail polling error: {e}")
+                error = True
+                labels['outcome'] = 'error'
+
+        delay = poll_scheduler.record_poll(new_count, error, len(manager.active_connections))
+        await poll_scheduler.sleep(delay)
+
+
+# ── Email Bodies ────────────────────────────────────────
+
+# Metadata-only syncs store no body; it is fetched from Gmail on first open,
+# saved to Mongo, and kept in a small LRU in front of the Mongo copy.
+EMAIL_BODY_CACHE_SIZE = int(os.environ.get('EMAIL_BODY_CACHE_SIZE', '256'))
+email_body_cache = OrderedDict()  # email id -> {'body': ..., 'body_html': ...}
+
+
+def _cache_email_body(email_id: str, bodies: dict):
+    email_body_cache[email_id] = bodies
+    email_body_cache.move_to_end(email_id)
+    while len(email_body_cache) > EMAIL_BODY_CACHE_SIZE:
+        email_body_cache.popitem(last=False)
+
+
+async def load_email_body(email: dict) -> dict:
+    """Return email with body/body_html filled in from the LRU, Mongo or Gmail."""
+    email_id = email.get('id', '')
+    bodies = email_body_cache.get(email_id)
+    if bodies is not None:
+        email_body_cache.move_to_end(email_id)
+    elif email.get('body_loaded', True):
+        bodies = await db.emails.find_one(
+            {"id": email_id}, {"_id": 0, "body": 1, "body_html": 1}
+        ) or {}
+        _cache_email_body(email_id, bodies)
+    elif email.get('gmail_id') and is_gmail_configured():
+        body, body_html = await run_gmail(fetch_email_body, email['gmail_id'])
+        bodies = {'body': body, 'body_html': body_html}
+        await db.emails.update_one(
+            {"gmail_id": email['gmail_id']}, {"$set": {**bodies, 'body_loaded': True}}
+        )
+        _cache_email_body(email_id, bodies)
+        email_index.add({**email, **bodies})
+    else:
+        bodies = {}
+    return {**email, 'body': bodies.get('body', ''), 'body_html': bodies.get('body_html', ''), 'body_loaded': True}
 
-# Store conversation history in memory for context
-ai_conversation_history = []
 
+async def store_email_bodies(emails: list):
+    """Save bodies from full-format Gmail messages for stored emails that lack them."""
+    ops = [
+        UpdateOne(
+            {"gmail_id": e['gmail_id'], "body_loaded": False},
+            {"$set": {"body": e['body'], "body_html": e['body_html'], "body_loaded": True}},
+        )
+        for e in emails if e.get('gmail_id') and e.get('body_loaded')
+    ]
+    if ops:
+        await db.emails.bulk_write(ops, ordered=False)
 
-async def process_ai_message(message: str, context: dict):
-    """Process AI chat messages using Google Gemini API directly."""
-    from google import genai
 
-    api_key = os.environ.get('GEMINI_API_KEY')
-    if not api_key:
-        return {"message": "AI assistant is not configured. Please add your GEMINI_API_KEY to the backend .env file.", "actions": []}
+# ── AI Assistant ────────────────────────────────────────
 
-    emails_cursor = db.emails.find(
+# Conversation memory: chat_messages is the record, and the last
+# AI_HISTORY_TURNS messages of recently active sessions are kept in an LRU.
+# Each cached message is capped at AI_HISTORY_MAX_CHARS, so memory stays
+# bounded by sessions x turns x chars however long the server runs.
+AI_HISTORY_TURNS = int(os.environ.get('AI_HISTORY_TURNS', '10'))
+AI_HISTORY_MAX_CHARS = int(os.environ.get('AI_HISTORY_MAX_CHARS', '2000'))
+AI_SESSION_CACHE_SIZE = int(os.environ.get('AI_SESSION_CACHE_SIZE', '256'))
+ai_sessions = OrderedDict()  # session_id -> deque of {"role", "text"}
+
+
+def _history_entry(chat_message: dict) -> dict:
+    """Model turn for a stored chat message. Assistant replies are sent back in
+    the JSON shape the model produced them in, so they are trimmed before encoding."""
+    content = chat_message["content"][:AI_HISTORY_MAX_CHARS]
+    if chat_message["role"] == "user":
+        return {"role": "user", "text": content}
+    return {"role": "model", "text": json.dumps({"message": content, "actions": chat_message.get("actions", [])})}
+
+
+async def get_conversation(session_id: str) -> deque:
+    """Last AI_HISTORY_TURNS messages of a session, loaded from Mongo on a cache miss."""
+    history = ai_sessions.get(session_id)
+    if history is not None:
+        ai_sessions.move_to_end(session_id)
+        return history
+    messages = await db.chat_messages.find(
+        {"session_id": session_id}, {"_id": 0, "role": 1, "content": 1, "actions": 1}
+    ).sort("timestamp", -1).to_list(AI_HISTORY_TURNS)
+    history = deque((_history_entry(m) for m in reversed(messages)), maxlen=AI_HISTORY_TURNS)
+    ai_sessions[session_id] = history
+    while len(ai_sessions) > AI_SESSION_CACHE_SIZE:
+        ai_sessions.popitem(last=False)
+    return history
+
+# The mailbox part of the system prompt is rebuilt only after the emails change.
+# Rows are tab-separated and trimmed to fit AI_CONTEXT_TOKEN_BUDGET (~4 chars/token).
+AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET', '3000'))
+AI_CONTEXT_RECENT_EMAILS = int(os.environ.get('AI_CONTEXT_RECENT_EMAILS', '20'))
+AI_CONTEXT_COLUMNS = "id\tfolder\tdate\tfrom\tto\tflags\tsubject\tpreview"
+# "generation" counts invalidations, so a rebuild that raced one is not cached
+ai_context_cache = {"text": None, "ids": set(), "generation": 0}
+
+# On top of the newest emails, the top-k matches for the chat message and the
+# selected email are looked up in email_index.
+AI_RETRIEVAL_TOP_K = int(os.environ.get('AI_RETRIEVAL_TOP_K', '15'))
+AI_RETRIEVAL_TOKEN_BUDGET = int(os.environ.get('AI_RETRIEVAL_TOKEN_BUDGET', '1500'))
+
+
+def invalidate_ai_context():
+    """Drop the cached mailbox context after a sync, new email, read or star change."""
+    ai_context_cache["text"] = None
+    ai_context_cache["generation"] += 1
+
+
+def _clean_cell(value: str, limit: int) -> str:
+    value = " ".join(str(value or "").split())
+    return value if len(value) <= limit else value[:limit - 1] + "…"
+
+
+def _encode_email_row(email: dict) -> str:
+    """One compact tab-separated row per email (see AI_CONTEXT_COLUMNS)."""
+    sender = email.get("from_email") or ""
+    if email.get("from_name") and email.get("from_name") != sender.split("@")[0]:
+        sender = f"{email['from_name']} <{sender}>"
+    flags = ("U" if not email.get("is_read") else "") + ("S" if email.get("starred") else "")
+    return "\t".join([
+        email.get("id", ""),
+        email.get("folder", ""),
+        (email.get("date") or "")[:16].replace("T", " "),
+        _clean_cell(sender, 60),
+        _clean_cell(email.get("to_email", ""), 40),
+        flags or "-",
+        _clean_cell(email.get("subject", ""), 100),
+        _clean_cell(email.get("preview", ""), 80),
+    ])
+
+
+def _encode_mailbox_context(emails: list, token_budget: int) -> str:
+    lines = [AI_CONTEXT_COLUMNS]
+    used = len(AI_CONTEXT_COLUMNS)
+    for email in emails:
+        row = _encode_email_row(email)
+        if (used + len(row) + 1) / 4 > token_budget:
+            break
+        lines.append(row)
+        used += len(row) + 1
+    return "\n".join(lines)
+
+
+async def get_mailbox_context() -> tuple:
+    """Return the encoded newest emails and their ids, from cache when the mailbox is unchanged."""
+    if ai_context_cache["text"] is not None:
+        return ai_context_cache["text"], ai_context_cache["ids"]
+    generation = ai_context_cache["generation"]
+    emails = await db.emails.find(
         {},
-        {"_id": 0, "id": 1, "gmail_id": 1, "thread_id": 1, "from_name": 1, "from_email": 1,
-         "to_email": 1, "to_name": 1, "subject": 1, "date": 1, "is_read": 1, "folder": 1,
-         "preview": 1, "starred": 1, "message_id": 1}
-    ).sort("date", -1)
-    emails_list = await emails_cursor.to_list(50)
-    email_context = json.dumps(emails_list, indent=2)
+        {"_id": 0, "id": 1, "from_name": 1, "from_email": 1, "to_email": 1, "subject": 1,
+         "date": 1, "is_read": 1, "folder": 1, "preview": 1, "starred": 1}
+    ).sort("date", -1).to_list(AI_CONTEXT_RECENT_EMAILS)
+    text = _encode_mailbox_context(emails, AI_CONTEXT_TOKEN_BUDGET)
+    ids = {email.get("id") for email in emails}
+    # The mailbox may have changed during the query; then serve this result once
+    if ai_context_cache["generation"] == generation:
+        ai_context_cache["text"] = text
+        ai_context_cache["ids"] = ids
+    return text, ids
+
+
+def get_relevant_email_context(message: str, context: dict, listed_ids: set) -> str:
+    """Encode the indexed emails most relevant to the message and selected email,
+    leaving out listed_ids (those already listed among the newest)."""
+    query = " ".join([message, context.get('selectedEmailSubject') or '', context.get('selectedEmailFrom') or ''])
+    email_ids = [email_id for email_id, _ in email_index.search(query, AI_RETRIEVAL_TOP_K)]
+    selected_id = context.get('selectedEmailId')
+    if selected_id in email_index.meta and selected_id not in email_ids:
+        email_ids.insert(0, selected_id)
+    emails = [email_index.meta[email_id] for email_id in email_ids
+              if email_id not in listed_ids]
+    if not emails:
+        return ""
+    return _encode_mailbox_context(emails, AI_RETRIEVAL_TOKEN_BUDGET)
+
+
+async def load_email_index():
+    """Build email_index from everything stored in Mongo."""
+    email_index.clear()
+    async for email in db.emails.find({}, {"_id": 0, "body_html": 0}):
+        email_index.add(email)
+    logger.info(f"Email retrieval index built with {len(email_index)} emails")
+
+
+AI_NOT_CONFIGURED = {"message": "AI assistant is not configured. Please add your GEMINI_API_KEY to the backend .env file.", "actions": []}
+AI_SERVICE_ERROR = {"message": "Sorry, I encountered an error with the AI service. Please check your GEMINI_API_KEY.", "actions": []}
+
+
+async def _build_system_prompt(message: str, context: dict) -> str:
+    """Build the Gemini system instruction for the current mailbox and UI state."""
+    email_context, listed_ids = await get_mailbox_context()
+    relevant_context = get_relevant_email_context(message, context, listed_ids)
+    if relevant_context:
+        email_context += f"""
+
+OLDER EMAILS RELEVANT TO THIS REQUEST (same columns, best match first):
+{relevant_context}"""
 
     current_view = context.get('currentView', 'inbox')
     selected_email_id = context.get('selectedEmailId', 'none')
@@ -309,7 +1036,7 @@ async def process_ai_message(message: str, context: dict):
 
     system_prompt = f"""You are an AI email assistant that controls a mail application UI. You help users manage their REAL emails by executing actions on the interface. The user's email is {user_email}.
 
-AVAILABLE EMAILS IN THE SYSTEM:
+AVAILABLE EMAILS IN THE SYSTEM (newest first, one per line, tab-separated columns; flags: U = unread, S = starred, - = none):
 {email_context}
 
 CURRENT UI STATE:
@@ -343,64 +1070,222 @@ RULES:
 - When user says "send email to X about Y", use compose action to fill the form. The user will confirm before sending.
 - When user says "reply to this email" while viewing an email, use "reply" action with the selected email's ID and compose a helpful reply body.
 - When searching/filtering: use "filter" action with relevant params.
-- When user wants to open/read an email: use "open_email" with the matching email id (use the "id" field or "gmail_id" field).
+- When user wants to open/read an email: use "open_email" with the matching email id (the "id" column).
 - Always be friendly and explain what you're doing.
 - For date filters, use ISO format dates.
 - When user says "show me unread" or "only unread", set unread_only to true.
 - When user wants to see all emails again, use clear_filters.
 - If user asks something that doesn't require an action (like "how many emails do I have?"), just answer in the message with no actions.
 """
+    return system_prompt
 
-    try:
-        client = genai.Client(api_key=api_key)
 
-        # Build conversation contents with history
-        contents = []
-        for hist_msg in ai_conversation_history[-10:]:
-            contents.append(genai.types.Content(
-                role=hist_msg["role"],
-                parts=[genai.types.Part(text=hist_msg["text"])]
-            ))
+def _build_ai_contents(genai, history: deque, message: str) -> list:
+    """Conversation contents: recent history plus the new user message."""
+    contents = []
+    for hist_msg in history:
         contents.append(genai.types.Content(
-            role="user",
-            parts=[genai.types.Part(text=message)]
+            role=hist_msg["role"],
+            parts=[genai.types.Part(text=hist_msg["text"])]
         ))
+    contents.append(genai.types.Content(
+        role="user",
+        parts=[genai.types.Part(text=message)]
+    ))
+    return contents
+
+
+def _parse_ai_response(response_text: str) -> dict:
+    """Parse the model's JSON reply."""
+    response_text = response_text.strip()
+
+    # Strip markdown code blocks if present
+    if response_text.startswith("```"):
+        lines = response_text.split("\n")
+        start = 1
+        end = len(lines) - 1
+        for i, line in enumerate(lines):
+            if i == 0:
+                continue
+            if line.strip().startswith("```"):
+                end = i
+                break
+        response_text = "\n".join(lines[start:end])
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=contents,
-            config=genai.types.GenerateContentConfig(
-                system_instruction=system_prompt,
-                temperature=0.3,
-            ),
-        )
-
-        response_text = response.text.strip()
-
-        # Store in conversation history
-        ai_conversation_history.append({"role": "user", "text": message})
-        ai_conversation_history.append({"role": "model", "text": response_text})
-
-        # Strip markdown code blocks if present
-        if response_text.startswith("```"):
-            lines = response_text.split("\n")
-            start = 1
-            end = len(lines) - 1
-            for i, line in enumerate(lines):
-                if i == 0:
-                    continue
-                if line.strip().startswith("```"):
-                    end = i
-                    break
-            response_text = "\n".join(lines[start:end])
-
-        parsed = json.loads(response_text)
-        return parsed
+    try:
+        return json.loads(response_text)
     except json.JSONDecodeError:
         return {"message": response_text, "actions": []}
+
+
+async def process_ai_message(message: str, context: dict, session_id: str):
+    """Process AI chat messages using Google Gemini API directly."""
+    from google import genai
+
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        return AI_NOT_CONFIGURED
+
+    system_prompt = await _build_system_prompt(message, context)
+    history = await get_conversation(session_id)
+
+    try:
+        client = genai.Client(api_key=api_key)
+        async with ai_semaphore:
+            with ai_request_seconds.time(mode='chat', outcome='success') as labels:
+                try:
+                    response = await client.aio.models.generate_content(
+                        model="gemini-2.5-flash",
+                        contents=_build_ai_contents(genai, history, message),
+                        config=genai.types.GenerateContentConfig(
+                            system_instruction=system_prompt,
+                            temperature=0.3,
+                        ),
+                    )
+                except Exception:
+                    labels['outcome'] = 'error'
+                    raise
+        return _parse_ai_response(response.text)
     except Exception as e:
         logger.error(f"Gemini API error: {e}")
-        return {"message": f"Sorry, I encountered an error with the AI service. Please check your GEMINI_API_KEY.", "actions": []}
+        return AI_SERVICE_ERROR
+
+
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def _read_partial_json_string(text: str, i: int) -> tuple:
+    """Decode the JSON string starting at text[i] == '"', which may be cut off.
+    Returns (decoded_so_far, index_after_string, complete)."""
+    out = []
+    i += 1
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '"':
+            return ''.join(out), i + 1, True
+        if c != '\\':
+            out.append(c)
+            i += 1
+            continue
+        if i + 1 >= n:
+            break
+        escape = text[i + 1]
+        if escape != 'u':
+            out.append(_JSON_ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        if i + 6 > n:
+            break
+        code = int(text[i + 2:i + 6], 16)
+        if 0xD800 <= code < 0xDC00:
+            # High surrogate: wait for the low half before emitting anything
+            if i + 12 > n:
+                break
+            if text[i + 6:i + 8] == '\\u':
+                low = int(text[i + 8:i + 12], 16)
+                code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                i += 6
+        out.append(chr(code))
+        i += 6
+    return ''.join(out), n, False
+
+
+def _scan_partial_ai_json(text: str) -> tuple:
+    """Extract what is already readable from a streamed {"message", "actions"} reply.
+    Returns (message_so_far, complete_actions)."""
+    message = ''
+    actions = []
+    depth = 0
+    key = None
+    expect_key = False
+    action_start = None
+    i = text.find('{')
+    if i < 0:
+        return message, actions
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c == '"':
+            value, end, complete = _read_partial_json_string(text, i)
+            if depth == 1 and expect_key:
+                if not complete:
+                    break
+                key = value
+            elif depth == 1 and key == 'message':
+                message = value
+            if not complete:
+                break
+            i = end
+            continue
+        if c in '{[':
+            if depth == 2 and key == 'actions' and c == '{':
+                action_start = i
+            depth += 1
+            expect_key = depth == 1
+        elif c in '}]':
+            depth -= 1
+            if depth == 2 and key == 'actions' and c == '}' and action_start is not None:
+                try:
+                    actions.append(json.loads(text[action_start:i + 1]))
+                except json.JSONDecodeError:
+                    pass
+                action_start = None
+        elif depth == 1 and c == ':':
+            expect_key = False
+        elif depth == 1 and c == ',':
+            expect_key = True
+        i += 1
+    return message, actions
+
+
+async def stream_ai_message(message: str, context: dict, session_id: str):
+    """Stream a chat reply as (event, data) pairs: "message" text deltas and
+    "action" entries as soon as they parse, then "done" with the full result."""
+    from google import genai
+
+    api_key = os.environ.get('GEMINI_API_KEY')
+    if not api_key:
+        yield "done", AI_NOT_CONFIGURED
+        return
+
+    system_prompt = await _build_system_prompt(message, context)
+    history = await get_conversation(session_id)
+
+    chunks = []
+    sent_message = ''
+    sent_actions = 0
+    try:
+        client = genai.Client(api_key=api_key)
+        async with ai_semaphore:
+            with ai_request_seconds.time(mode='stream', outcome='error') as labels:
+                started = time.perf_counter()
+                stream = await client.aio.models.generate_content_stream(
+                    model="gemini-2.5-flash",
+                    contents=_build_ai_contents(genai, history, message),
+                    config=genai.types.GenerateContentConfig(
+                        system_instruction=system_prompt,
+                        temperature=0.3,
+                    ),
+                )
+                async for chunk in stream:
+                    if not chunks:
+                        ai_first_chunk_seconds.observe(time.perf_counter() - started)
+                    chunks.append(chunk.text or '')
+                    partial_message, actions = _scan_partial_ai_json(''.join(chunks))
+                    if len(partial_message) > len(sent_message):
+                        yield "message", {"delta": partial_message[len(sent_message):]}
+                        sent_message = partial_message
+                    for action in actions[sent_actions:]:
+                        yield "action", {"action": action}
+                    sent_actions = len(actions)
+                labels['outcome'] = 'success'
+    except Exception as e:
+        logger.error(f"Gemini API streaming error: {e}")
+        yield "done", AI_SERVICE_ERROR
+        return
+
+    yield "done", _parse_ai_response(''.join(chunks))
 
 
 # ── API Routes ──────────────────────────────────────────
@@ -412,6 +1297,16 @@ async def health_check():
     return {"status": "ok", "message": "R-Mail Backend is running"}
 
 
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """Prometheus scrape endpoint. Set METRICS_TOKEN to require it as a bearer token."""
+    token = os.environ.get('METRICS_TOKEN')
+    supplied = request.headers.get('authorization', '')
+    if token and not hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @api_router.get("/")
 async def root():
     return {"message": "AI Mail App API"}
@@ -452,22 +1347,21 @@ async def auth_callback(code: str):
         flow = _get_oauth_flow()
         if not flow:
             return {"success": False, "error": "Gmail client credentials not configured"}
-        flow.fetch_token(code=code)
+        await run_gmail(flow.fetch_token, code=code)
         creds = flow.credentials
         if not creds.refresh_token:
             return {"success": False, "error": "No refresh token received. Please revoke app access and try again."}
 
         # Store tokens
         os.environ['GMAIL_REFRESH_TOKEN'] = creds.refresh_token
-        profile = get_user_profile()
+        profile = await run_gmail(get_user_profile)
         user_profile_cache = profile
         await store_tokens_to_db(creds.refresh_token, profile.get('email', ''))
 
-        # Sync emails
-        await db.emails.delete_many({})
-        inbox_count = await sync_gmail_to_db('inbox', 50)
-        sent_count = await sync_gmail_to_db('sent', 30)
-        asyncio.create_task(poll_gmail_for_new_emails())
+        # Sync emails (incremental if this account has a checkpoint)
+        synced = await resync_gmail()
+        inbox_count, sent_count = synced['inbox'], synced['sent']
+        start_polling()
 
         # Generate JWT session token
         user_email = profile.get('email', '')
@@ -486,46 +1380,99 @@ async def auth_logout(credentials: HTTPAuthorizationCredentials = Depends(securi
     global user_profile_cache, gmail_history_id
     # Blacklist the current JWT so it can't be reused
     if credentials:
-        await db.jwt_blacklist.insert_one({
-            'token': credentials.credentials,
-            'blacklisted_at': datetime.now(timezone.utc).isoformat(),
-        })
+        revoke_token(credentials.credentials)
+        # Upsert so logging the same token out twice (e.g. from two tabs) is a no-op
+        await db.jwt_blacklist.update_one(
+            {'token': credentials.credentials},
+            {'$setOnInsert': {
+                'token_hash': _token_hash(credentials.credentials),
+                'blacklisted_at': datetime.now(timezone.utc),
+            }},
+            upsert=True,
+        )
     await db.auth_tokens.delete_many({})
     await db.emails.delete_many({})
+    await db.sync_state.delete_many({})
     await db.chat_messages.delete_many({})
+    ai_sessions.clear()
+    email_body_cache.clear()
+    email_index.clear()
+    invalidate_ai_context()
     user_profile_cache = None
     gmail_history_id = None
     os.environ.pop('GMAIL_REFRESH_TOKEN', None)
+    invalidate_gmail_service()
     logger.info("User logged out, tokens cleared")
     return {"success": True}
 
 
+# List views only need headers, preview and flags; full content comes from GET /emails/{id}
+EMAIL_LIST_PROJECTION = {"_id": 0, "body": 0, "body_html": 0}
+EMAIL_PAGE_MAX = 200
+
+
+def _encode_cursor(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode()
+
+
+# Cursor fields: "o" offset (text search), "d" date and "i" id (keyset pages)
+CURSOR_FIELD_TYPES = {"o": int, "d": str, "i": str}
+
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    if not isinstance(data, dict) or any(
+        type(data[field]) is not kind for field, kind in CURSOR_FIELD_TYPES.items() if field in data
+    ) or data.get("o", 0) < 0:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    return data
+
+
 @api_router.get("/emails")
 async def get_emails(
+    response: Response,
     folder: str = "inbox",
     sender: str = "",
     keyword: str = "",
     unread_only: bool = False,
     date_from: str = "",
     date_to: str = "",
+    search: str = "text",
+    limit: int = 50,
+    cursor: str = "",
     user_email: str = Depends(get_current_user),
 ):
+    """List emails in a folder, newest first, without body fields.
+    Keywords use the text index and are ranked by relevance unless
+    search="regex" asks for plain substring matching. The next page is
+    requested by passing the X-Next-Cursor response header back as cursor."""
     query = {"folder": folder}
     conditions = []
+    text_search = bool(keyword) and search != "regex"
+    limit = max(1, min(limit, EMAIL_PAGE_MAX))
+    page = _decode_cursor(cursor) if cursor else {}
 
     if sender:
+        sender_pattern = re.escape(sender)
         conditions.append({
             "$or": [
-                {"from_name": {"$regex": sender, "$options": "i"}},
-                {"from_email": {"$regex": sender, "$options": "i"}},
+                {"from_name": {"$regex": sender_pattern, "$options": "i"}},
+                {"from_email": {"$regex": sender_pattern, "$options": "i"}},
             ]
         })
-    if keyword:
+    if text_search:
+        # Sender terms also feed the ranking, since the text index covers sender fields
+        query["$text"] = {"$search": f"{keyword} {sender}".strip()}
+    elif keyword:
+        keyword_pattern = re.escape(keyword)
         conditions.append({
             "$or": [
-                {"subject": {"$regex": keyword, "$options": "i"}},
-                {"body": {"$regex": keyword, "$options": "i"}},
-                {"preview": {"$regex": keyword, "$options": "i"}},
+                {"subject": {"$regex": keyword_pattern, "$options": "i"}},
+                {"body": {"$regex": keyword_pattern, "$options": "i"}},
+                {"preview": {"$regex": keyword_pattern, "$options": "i"}},
             ]
         })
     if unread_only:
@@ -535,22 +1482,52 @@ async def get_emails(
     if date_to:
         conditions.append({"date": {"$lte": date_to}})
 
+    if not text_search and page:
+        # Keyset pagination on (date, id), matching the folder_date index order
+        conditions.append({
+            "$or": [
+                {"date": {"$lt": page.get("d", "")}},
+                {"date": page.get("d", ""), "id": {"$lt": page.get("i", "")}},
+            ]
+        })
+
     if conditions:
         query["$and"] = conditions
 
-    emails = await db.emails.find(query, {"_id": 0}).sort("date", -1).to_list(200)
+    if text_search:
+        # Relevance order has no stable key, so text search pages by offset
+        offset = page.get("o", 0)
+        db_cursor = db.emails.find(
+            query, {**EMAIL_LIST_PROJECTION, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"}), ("date", -1)]).skip(offset)
+    else:
+        db_cursor = db.emails.find(query, EMAIL_LIST_PROJECTION).sort([("date", -1), ("id", -1)])
+    emails = await db_cursor.to_list(limit + 1)
+
+    if len(emails) > limit:
+        emails = emails[:limit]
+        last = emails[-1]
+        if text_search:
+            next_page = {"o": offset + limit}
+        else:
+            next_page = {"d": last.get("date", ""), "i": last.get("id", "")}
+        response.headers["X-Next-Cursor"] = _encode_cursor(next_page)
     return emails
 
 
 @api_router.get("/emails/{email_id}")
 async def get_email(email_id: str, user_email: str = Depends(get_current_user)):
-    # Try by id first, then by gmail_id
-    email = await db.emails.find_one({"id": email_id}, {"_id": 0})
+    # Try by id first, then by gmail_id; bodies come from load_email_body
+    email = await db.emails.find_one({"id": email_id}, EMAIL_LIST_PROJECTION)
     if not email:
-        email = await db.emails.find_one({"gmail_id": email_id}, {"_id": 0})
+        email = await db.emails.find_one({"gmail_id": email_id}, EMAIL_LIST_PROJECTION)
     if not email:
         return {"error": "Email not found"}
-    return email
+    try:
+        return await load_email_body(email)
+    except Exception as e:
+        logger.error(f"Failed to load body for {email_id}: {e}")
+        return {**email, 'body': '', 'body_html': ''}
 
 
 @api_router.put("/emails/{email_id}/read")
@@ -559,12 +1536,15 @@ async def mark_as_read(email_id: str, user_email: str = Depends(get_current_user
     result = await db.emails.update_one({"id": email_id}, {"$set": {"is_read": True}})
     if result.modified_count == 0:
         await db.emails.update_one({"gmail_id": email_id}, {"$set": {"is_read": True}})
+    invalidate_ai_context()
 
     # Also mark as read in Gmail
     email = await db.emails.find_one({"$or": [{"id": email_id}, {"gmail_id": email_id}]})
+    if email:
+        email_index.update(email["id"], {"is_read": True})
     if email and email.get("gmail_id") and is_gmail_configured():
         try:
-            mark_as_read_gmail(email["gmail_id"])
+            await run_gmail(mark_as_read_gmail, email["gmail_id"])
         except Exception as e:
             logger.error(f"Failed to mark as read in Gmail: {e}")
 
@@ -583,11 +1563,13 @@ async def toggle_star(email_id: str, user_email: str = Depends(get_current_user)
             {"$or": [{"id": email_id}, {"gmail_id": email_id}]},
             {"$set": {"starred": new_val}}
         )
+        invalidate_ai_context()
+        email_index.update(email["id"], {"starred": new_val})
 
         # Sync star to Gmail
         if email.get("gmail_id") and is_gmail_configured():
             try:
-                toggle_star_gmail(email["gmail_id"], new_val)
+                await run_gmail(toggle_star_gmail, email["gmail_id"], new_val)
             except Exception as e:
                 logger.error(f"Failed to toggle star in Gmail: {e}")
 
@@ -601,7 +1583,8 @@ async def send_email(email_data: EmailSend, user_email: str = Depends(get_curren
     if is_gmail_configured():
         try:
             # Send via Gmail
-            sent_email = send_gmail(
+            sent_email = await run_gmail(
+                send_gmail,
                 to_email=email_data.to_email,
                 subject=email_data.subject,
                 body=email_data.body,
@@ -611,10 +1594,11 @@ async def send_email(email_data: EmailSend, user_email: str = Depends(get_curren
             sent_email['folder'] = 'sent'
             sent_email['is_read'] = True
 
-            # Save to DB
-            await db.emails.insert_one(sent_email)
+            # Save to DB; the poller may already have stored it from Gmail history
+            inserted = await upsert_emails([sent_email])
             safe_doc = {k: v for k, v in sent_email.items() if k != "_id"}
-            await manager.broadcast({"type": "email_sent", "email": safe_doc})
+            if inserted:
+                await manager.broadcast({"type": "email_sent", "email": safe_doc})
             logger.info(f"Real email sent to {email_data.to_email}")
             return safe_doc
         except Exception as e:
@@ -638,6 +1622,8 @@ async def send_email(email_data: EmailSend, user_email: str = Depends(get_curren
         )
         doc = email.model_dump()
         await db.emails.insert_one(doc)
+        invalidate_ai_context()
+        email_index.add(doc)
         safe_doc = {k: v for k, v in doc.items() if k != "_id"}
         await manager.broadcast({"type": "email_sent", "email": safe_doc})
         return safe_doc
@@ -655,16 +1641,21 @@ async def get_email_thread(email_id: str, user_email: str = Depends(get_current_
 
     if is_gmail_configured():
         try:
-            thread_msgs = fetch_thread(email["thread_id"])
+            thread_msgs = await run_gmail(fetch_thread, email["thread_id"])
+            await store_email_bodies(thread_msgs)
             return thread_msgs
         except Exception as e:
             logger.error(f"Error fetching thread: {e}")
 
-    # Fallback: get from DB by thread_id
+    # Fallback: get from DB by thread_id. Gmail is unavailable here, so bodies that
+    # were never fetched are left empty and the stored preview is shown instead
     msgs = await db.emails.find(
-        {"thread_id": email.get("thread_id")}, {"_id": 0}
+        {"thread_id": email.get("thread_id")}, EMAIL_LIST_PROJECTION
     ).sort("date", 1).to_list(50)
-    return msgs
+    return [
+        await load_email_body(msg) if msg.get('body_loaded', True) else {**msg, 'body': '', 'body_html': ''}
+        for msg in msgs
+    ]
 
 
 @api_router.post("/gmail/sync")
@@ -673,42 +1664,107 @@ async def gmail_sync(user_email: str = Depends(get_current_user)):
     if not is_gmail_configured():
         return {"error": "Gmail is not configured"}
 
-    # Clear old emails and re-sync
-    await db.emails.delete_many({})
-    inbox_count = await sync_gmail_to_db('inbox', 50)
-    sent_count = await sync_gmail_to_db('sent', 30)
-    return {"synced": {"inbox": inbox_count, "sent": sent_count}}
+    try:
+        synced = await resync_gmail()
+    except Exception as e:
+        logger.error(f"Gmail sync error: {e}")
+        return {"error": str(e)}
+    start_polling()
+    return {"synced": {"inbox": synced['inbox'], "sent": synced['sent']}, "mode": synced['mode']}
+
+
+@api_router.get("/gmail/poll-status")
+async def gmail_poll_status(user_email: str = Depends(get_current_user)):
+    """Current state of the adaptive Gmail poll loop."""
+    return {
+        **poll_scheduler.status(),
+        "running": poll_task is not None and not poll_task.done(),
+        "connections": len(manager.active_connections),
+    }
+
+
+@api_router.get("/gmail/quota-status")
+async def gmail_quota_status(user_email: str = Depends(get_current_user)):
+    """Gmail quota usage: available units, in-flight calls, retries and throttling."""
+    return gmail_quota.status()
+
+
+@api_router.get("/ws/status")
+async def websocket_status(user_email: str = Depends(get_current_user)):
+    """WebSocket fan-out metrics: connections, send queue depth and drops."""
+    return manager.stats()
+
+
+def _chat_session(session_id: str, user_email: str) -> str:
+    """Clients pass a session id per chat; older clients share one per account."""
+    return session_id or user_email
 
 
 @api_router.post("/ai/chat")
 async def ai_chat(request: ChatRequest, user_email: str = Depends(get_current_user)):
+    session_id = _chat_session(request.session_id, user_email)
     try:
-        result = await process_ai_message(request.message, request.context)
-
-        user_msg = ChatMessage(role="user", content=request.message)
-        assistant_msg = ChatMessage(
-            role="assistant",
-            content=result.get("message", ""),
-            actions=result.get("actions", []),
-        )
-        await db.chat_messages.insert_one(user_msg.model_dump())
-        await db.chat_messages.insert_one(assistant_msg.model_dump())
-
+        result = await process_ai_message(request.message, request.context, session_id)
+        await save_chat_exchange(session_id, request.message, result)
         return result
     except Exception as e:
         logger.error(f"AI chat error: {e}")
         return {"message": f"Sorry, I encountered an error. Please try again.", "actions": []}
 
 
+async def save_chat_exchange(session_id: str, message: str, result: dict):
+    """Persist a user message and the assistant's reply to chat_messages and
+    append both to the session's cached window."""
+    user_msg = ChatMessage(session_id=session_id, role="user", content=message)
+    assistant_msg = ChatMessage(
+        session_id=session_id,
+        role="assistant",
+        content=result.get("message", ""),
+        actions=result.get("actions", []),
+    )
+    docs = [user_msg.model_dump(), assistant_msg.model_dump()]
+    await db.chat_messages.insert_many(docs)
+    history = ai_sessions.get(session_id)
+    if history is not None:
+        history.extend(_history_entry(doc) for doc in docs)
+
+
+@api_router.post("/ai/chat/stream")
+async def ai_chat_stream(request: ChatRequest, user_email: str = Depends(get_current_user)):
+    """Server-sent events version of /ai/chat: message deltas and actions as they arrive."""
+    session_id = _chat_session(request.session_id, user_email)
+
+    async def events():
+        try:
+            async for event, data in stream_ai_message(request.message, request.context, session_id):
+                if event == "done":
+                    await save_chat_exchange(session_id, request.message, data)
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        except Exception as e:
+            logger.error(f"AI chat stream error: {e}")
+            error = {"message": "Sorry, I encountered an error. Please try again.", "actions": []}
+            yield f"event: done\ndata: {json.dumps(error)}\n\n"
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @api_router.get("/chat/history")
-async def get_chat_history(user_email: str = Depends(get_current_user)):
-    messages = await db.chat_messages.find({}, {"_id": 0}).sort("timestamp", 1).to_list(100)
-    return messages
+async def get_chat_history(session_id: str = "", user_email: str = Depends(get_current_user)):
+    """The latest 100 messages of a chat session, oldest first."""
+    messages = await db.chat_messages.find(
+        {"session_id": _chat_session(session_id, user_email)}, {"_id": 0}
+    ).sort("timestamp", -1).to_list(100)
+    return messages[::-1]
 
 
 @api_router.delete("/chat/history")
-async def clear_chat_history(user_email: str = Depends(get_current_user)):
-    await db.chat_messages.delete_many({})
+async def clear_chat_history(session_id: str = "", user_email: str = Depends(get_current_user)):
+    session_id = _chat_session(session_id, user_email)
+    await db.chat_messages.delete_many({"session_id": session_id})
+    ai_sessions.pop(session_id, None)
     return {"success": True}
 
 
@@ -716,13 +1772,20 @@ async def clear_chat_history(user_email: str = Depends(get_current_user)):
 
 @app.websocket("/api/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    # Reconnecting clients pass ?stream=...&last_seq=N to get the events they missed
+    last_seq = websocket.query_params.get("last_seq")
+    await manager.connect(
+        websocket,
+        last_seq=int(last_seq) if last_seq and last_seq.isdigit() else None,
+        stream=websocket.query_params.get("stream"),
+    )
+    poll_scheduler.wake()
     try:
         while True:
             data = await websocket.receive_text()
             msg = json.loads(data)
             if msg.get("type") == "ping":
-                await websocket.send_json({"type": "pong"})
+                await manager.send(websocket, {"type": "pong"})
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception:
@@ -733,12 +1796,17 @@ async def websocket_endpoint(websocket: WebSocket):
 
 app.include_router(api_router)
 
+app.add_middleware(MetricsMiddleware)
+if profiling.PROFILING_TOKEN:
+    # Opt-in per-request profiling, see profiling.py
+    app.add_middleware(profiling.RequestProfilerMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -753,6 +1821,27 @@ async def startup():
         logger.error(f"Failed to load tokens from DB at startup: {e}")
         logger.warning("MongoDB connection might be down or blocked. App will start but auth may fail.")
 
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Failed to ensure MongoDB indexes at startup: {e}")
+
+    try:
+        await load_revoked_tokens()
+    except Exception as e:
+        logger.error(f"Failed to load revoked tokens at startup: {e}")
+
+    try:
+        await load_email_index()
+    except Exception as e:
+        logger.error(f"Failed to build email retrieval index: {e}")
+
+    try:
+        await manager.load_events()
+    except Exception as e:
+        logger.error(f"Failed to load WebSocket replay buffer: {e}")
+    asyncio.create_task(refresh_revoked_tokens())
+
     # Run startup sync in BACKGROUND so we don't block the port binding
     asyncio.create_task(background_startup_sync())
 
@@ -766,17 +1855,15 @@ async def background_startup_sync():
             # Add a small delay to let server start up
             await asyncio.sleep(2)
             
-            user_profile_cache = get_user_profile()
+            user_profile_cache = await run_gmail(get_user_profile)
             logger.info(f"Authenticated as: {user_profile_cache.get('email', 'unknown')}")
 
-            # Clear old data and sync fresh
-            await db.emails.delete_many({})
-            inbox_count = await sync_gmail_to_db('inbox', 50)
-            sent_count = await sync_gmail_to_db('sent', 30)
-            logger.info(f"Synced {inbox_count} inbox + {sent_count} sent emails from Gmail")
+            # Apply changes since the last checkpoint (full resync if none/expired)
+            synced = await resync_gmail()
+            logger.info(f"Synced {synced['inbox']} inbox + {synced['sent']} sent emails from Gmail ({synced['mode']})")
 
             # Start real-time polling
-            asyncio.create_task(poll_gmail_for_new_emails())
+            start_polling()
         except Exception as e:
             logger.error(f"Gmail startup error: {e}")
             logger.info("Falling back to empty inbox. Please check your Gmail credentials.")
@@ -787,3 +1874,4 @@ async def background_startup_sync():
 @app.on_event("shutdown")
 async def shutdown():
     client.close()
+    gmail_executor.shutdown(wait=False)
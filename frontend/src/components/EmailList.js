@@ -38,8 +38,9 @@ function FilterChip({ label, onClear }) {
 }
 
 export function EmailList() {
-  const { currentView, emails, openEmail, toggleStar, filters, setFilters, clearFilters } = useMailContext();
-  const list = currentView === 'sent' ? emails.sent : emails.inbox;
+  const { currentView, emails, nextCursors, loadMoreEmails, openEmail, toggleStar, filters, setFilters, clearFilters } = useMailContext();
+  const folder = currentView === 'sent' ? 'sent' : 'inbox';
+  const list = emails[folder];
 
   const hasFilters = filters.sender || filters.keyword || filters.dateFrom || filters.dateTo || filters.unreadOnly;
 
@@ -159,6 +160,15 @@ export function EmailList() {
             </div>
           ))
         )}
+        {filtered.length > 0 && nextCursors[folder] && (
+          <button
+            onClick={() => loadMoreEmails(folder)}
+            className="w-full py-3 text-[12px] font-medium rounded-xl btn-press"
+            style={{ color: 'var(--accent)' }}
+          >
+            Load more
+          </button>
+        )}
       </div>
     </div>
   );
@@ -5,6 +5,20 @@ import { toast } from 'sonner';
 const API = process.env.REACT_APP_API_URL || 'http://localhost:8001/api';
 const WS_URL = process.env.REACT_APP_WS_URL || 'ws://localhost:8001/api/ws';
 const TOKEN_KEY = 'rmail-auth-token';
+const CHAT_SESSION_KEY = 'rmail-chat-session';
+// Emails per list request; the server caps this at 200 and returns an
+// X-Next-Cursor header when more are available
+const EMAIL_PAGE_SIZE = 200;
+
+// The AI assistant keeps one conversation per chat session
+const getChatSession = () => {
+  let sessionId = localStorage.getItem(CHAT_SESSION_KEY);
+  if (!sessionId) {
+    sessionId = crypto.randomUUID();
+    localStorage.setItem(CHAT_SESSION_KEY, sessionId);
+  }
+  return sessionId;
+};
 
 // Shared axios instance that auto-attaches JWT
 const api = axios.create();
@@ -23,6 +37,7 @@ export { api, API }; // export for use in other components
 export function MailProvider({ children }) {
   const [currentView, setCurrentView] = useState('inbox');
   const [emails, setEmails] = useState({ inbox: [], sent: [] });
+  const [nextCursors, setNextCursors] = useState({ inbox: null, sent: null });
   const [selectedEmail, setSelectedEmail] = useState(null);
   const [filters, setFilters] = useState({ sender: '', keyword: '', dateFrom: '', dateTo: '', unreadOnly: false });
   const [composeData, setComposeData] = useState({ to: '', subject: '', body: '' });
@@ -36,6 +51,8 @@ export function MailProvider({ children }) {
   const [authLoading, setAuthLoading] = useState(true); // prevents login page flash
   const [theme, setTheme] = useState(() => localStorage.getItem('rmail-theme') || 'light');
   const wsRef = useRef(null);
+  const wsStreamRef = useRef({ stream: null, seq: null }); // last seen event, for replay on reconnect
+  const fetchAllEmailsRef = useRef(null);
 
   // ── Theme ───────────────────────────────────────
   useEffect(() => {
@@ -90,42 +107,72 @@ export function MailProvider({ children }) {
     localStorage.removeItem(TOKEN_KEY);
     setAuthStatus({ gmail_configured: false, email: '', mode: 'disconnected', can_login: true });
     setEmails({ inbox: [], sent: [] });
+    setNextCursors({ inbox: null, sent: null });
     setSelectedEmail(null);
     setChatMessages([]);
     toast.success('Logged out successfully');
   }, []);
 
   // ── Emails ──────────────────────────────────────
+  const emailParams = useCallback((folder, filterOverride = null) => {
+    const f = filterOverride || filters;
+    const params = { folder, limit: EMAIL_PAGE_SIZE };
+    if (f.sender) params.sender = f.sender;
+    if (f.keyword) params.keyword = f.keyword;
+    if (f.unreadOnly) params.unread_only = true;
+    if (f.dateFrom) params.date_from = f.dateFrom;
+    if (f.dateTo) params.date_to = f.dateTo;
+    return params;
+  }, [filters]);
+
   const fetchEmails = useCallback(async (folder = 'inbox', filterOverride = null) => {
     try {
-      const f = filterOverride || filters;
-      const params = { folder };
-      if (f.sender) params.sender = f.sender;
-      if (f.keyword) params.keyword = f.keyword;
-      if (f.unreadOnly) params.unread_only = true;
-      if (f.dateFrom) params.date_from = f.dateFrom;
-      if (f.dateTo) params.date_to = f.dateTo;
-      const res = await api.get(`${API}/emails`, { params });
+      const res = await api.get(`${API}/emails`, { params: emailParams(folder, filterOverride) });
       setEmails(prev => ({ ...prev, [folder]: res.data }));
+      setNextCursors(prev => ({ ...prev, [folder]: res.headers['x-next-cursor'] || null }));
       if (folder === 'inbox') {
         setUnreadCount(res.data.filter(e => !e.is_read).length);
       }
     } catch (err) {
       console.error(`Failed to fetch ${folder}:`, err);
     }
-  }, [filters]);
+  }, [emailParams]);
+
+  const loadMoreEmails = useCallback(async (folder = 'inbox') => {
+    const cursor = nextCursors[folder];
+    if (!cursor) return;
+    try {
+      const res = await api.get(`${API}/emails`, { params: { ...emailParams(folder), cursor } });
+      // Offset pages (keyword search) can overlap once new mail has arrived
+      const seen = new Set(emails[folder].map(e => e.id));
+      const page = res.data.filter(e => !seen.has(e.id));
+      setEmails(prev => ({ ...prev, [folder]: [...prev[folder], ...page] }));
+      setNextCursors(prev => ({ ...prev, [folder]: res.headers['x-next-cursor'] || null }));
+      if (folder === 'inbox') {
+        setUnreadCount(prev => prev + page.filter(e => !e.is_read).length);
+      }
+    } catch (err) {
+      console.error(`Failed to load more ${folder}:`, err);
+    }
+  }, [nextCursors, emails, emailParams]);
 
   const fetchAllEmails = useCallback(async () => {
     await Promise.all([fetchEmails('inbox'), fetchEmails('sent')]);
   }, [fetchEmails]);
 
+  useEffect(() => {
+    fetchAllEmailsRef.current = fetchAllEmails;
+  }, [fetchAllEmails]);
+
   // ── WebSocket ───────────────────────────────────
   useEffect(() => {
     if (!authStatus.gmail_configured) return;
 
     const connectWS = () => {
       if (wsRef.current?.readyState === WebSocket.OPEN) return;
-      const ws = new WebSocket(WS_URL);
+      const { stream, seq } = wsStreamRef.current;
+      const url = stream && seq !== null ? `${WS_URL}?stream=${encodeURIComponent(stream)}&last_seq=${seq}` : WS_URL;
+      const ws = new WebSocket(url);
       wsRef.current = ws;
       ws.onopen = () => setWsConnected(true);
       ws.onclose = () => {
@@ -135,12 +182,34 @@ export function MailProvider({ children }) {
       ws.onmessage = (evt) => {
         try {
           const data = JSON.parse(evt.data);
+          if (data.type === 'hello') {
+            // Keep our position unless we are resuming the same stream
+            if (wsStreamRef.current.stream !== data.stream) wsStreamRef.current = { stream: data.stream, seq: data.seq };
+            return;
+          }
+          if (data.type === 'resync_required') {
+            // Missed events are no longer available — reload everything
+            wsStreamRef.current = { stream: data.stream, seq: data.seq };
+            fetchAllEmailsRef.current?.();
+            return;
+          }
+          if (data.seq) wsStreamRef.current.seq = Math.max(wsStreamRef.current.seq || 0, data.seq);
           if (data.type === 'new_email' && data.email) {
             setEmails(prev => ({ ...prev, inbox: [data.email, ...prev.inbox] }));
             setUnreadCount(prev => prev + 1);
             toast.info(`New email from ${data.email.from_name}`);
           } else if (data.type === 'email_sent' && data.email) {
             setEmails(prev => ({ ...prev, sent: [data.email, ...prev.sent] }));
+          } else if (data.type === 'emails_updated' && data.changes) {
+            // changes maps gmail_id to the changed fields
+            const update = e => {
+              const changes = data.changes[e.gmail_id] || data.changes[e.id];
+              return changes ? { ...e, ...changes } : e;
+            };
+            setEmails(prev => ({ inbox: prev.inbox.map(update), sent: prev.sent.map(update) }));
+          } else if (data.type === 'email_deleted' && data.ids) {
+            const keep = e => !data.ids.includes(e.id) && !data.ids.includes(e.gmail_id);
+            setEmails(prev => ({ inbox: prev.inbox.filter(keep), sent: prev.sent.filter(keep) }));
           }
         } catch (e) { /* ignore */ }
       };
@@ -214,7 +283,7 @@ export function MailProvider({ children }) {
     if (!authStatus.gmail_configured) return;
     (async () => {
       try {
-        const res = await api.get(`${API}/chat/history`);
+        const res = await api.get(`${API}/chat/history`, { params: { session_id: getChatSession() } });
         if (res.data && res.data.length > 0) setChatMessages(res.data);
       } catch (e) { /* ignore */ }
     })();
@@ -233,6 +302,12 @@ export function MailProvider({ children }) {
   const openEmail = useCallback(async (email) => {
     setSelectedEmail(email);
     setCurrentView('detail');
+    // List responses leave out body fields — load the full message
+    api.get(`${API}/emails/${email.id}`).then(res => {
+      if (res.data && !res.data.error) {
+        setSelectedEmail(prev => (prev?.id === email.id ? { ...prev, ...res.data } : prev));
+      }
+    }).catch(() => { /* ignore */ });
     if (!email.is_read) {
       try {
         await api.put(`${API}/emails/${email.id}/read`);
@@ -367,16 +442,45 @@ export function MailProvider({ children }) {
         activeFilters: filters,
         userEmail: authStatus.email,
       };
-      const res = await api.post(`${API}/ai/chat`, { message, context });
-      const assistantMsg = {
-        role: 'assistant',
-        content: res.data.message || '',
-        actions: res.data.actions || [],
-        timestamp: new Date().toISOString(),
-      };
-      setChatMessages(prev => [...prev, assistantMsg]);
-      if (res.data.actions?.length > 0) await executeAIActions(res.data.actions);
-      return res.data;
+      // Stream the reply (SSE) so text shows up as soon as the model produces it
+      const res = await fetch(`${API}/ai/chat/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', Authorization: `Bearer ${localStorage.getItem(TOKEN_KEY)}` },
+        body: JSON.stringify({ message, context, session_id: getChatSession() }),
+      });
+      if (!res.ok || !res.body) throw new Error(`AI stream failed: ${res.status}`);
+      const timestamp = new Date().toISOString();
+      const updateReply = (patch) => setChatMessages(prev => {
+        const last = prev[prev.length - 1];
+        if (last?.role === 'assistant' && last.timestamp === timestamp) {
+          return [...prev.slice(0, -1), { ...last, ...patch(last) }];
+        }
+        return [...prev, { role: 'assistant', content: '', actions: [], timestamp, ...patch({ content: '', actions: [] }) }];
+      });
+
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let result = null;
+      while (!result) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let sep;
+        while ((sep = buffer.indexOf('\n\n')) >= 0) {
+          const raw = buffer.slice(0, sep);
+          buffer = buffer.slice(sep + 2);
+          const event = raw.match(/^event: (.*)$/m)?.[1];
+          const data = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] || '{}');
+          if (event === 'message') updateReply(m => ({ content: m.content + data.delta }));
+          else if (event === 'action') updateReply(m => ({ actions: [...m.actions, data.action] }));
+          else if (event === 'done') result = data;
+        }
+      }
+      if (!result) throw new Error('AI stream ended early');
+      updateReply(() => ({ content: result.message || '', actions: result.actions || [] }));
+      if (result.actions?.length > 0) await executeAIActions(result.actions);
+      return result;
     } catch (err) {
       setChatMessages(prev => [...prev, { role: 'assistant', content: 'Sorry, something went wrong.', actions: [], timestamp: new Date().toISOString() }]);
       return null;
@@ -385,7 +489,7 @@ export function MailProvider({ children }) {
 
   const clearChat = useCallback(async () => {
     try {
-      await api.delete(`${API}/chat/history`);
+      await api.delete(`${API}/chat/history`, { params: { session_id: getChatSession() } });
       setChatMessages([]);
     } catch (e) { /* ignore */ }
   }, []);
@@ -404,7 +508,7 @@ export function MailProvider({ children }) {
 
   const value = {
     currentView, setCurrentView, navigateTo,
-    emails, selectedEmail, setSelectedEmail, openEmail,
+    emails, nextCursors, loadMoreEmails, selectedEmail, setSelectedEmail, openEmail,
     filters, setFilters, applyFilters, clearFilters,
     composeData, setComposeData, showCompose, setShowCompose,
     chatMessages, sendAIMessage, clearChat,
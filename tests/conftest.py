@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+# The backend modules import each other as top-level modules
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+# server.py reads these at import time; the client does not connect until used
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'rmail_test')
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from server import _read_partial_json_string, _scan_partial_ai_json
+
+REPLIES = [
+    {"message": "Hello", "actions": []},
+    {
+        "message": 'Quote " backslash \\ slash / newline \n tab \t accent é',
+        "actions": [{"type": "filter", "sender": "a{b}c", "keyword": "[x], y: z"}],
+    },
+    {
+        "message": "Emoji 😀 and clef 𝄞",
+        "actions": [
+            {"type": "compose", "to": "bob@example.com", "body": '{"nested": "}"} \\"'},
+            {"type": "navigate", "view": "sent"},
+        ],
+    },
+    {"message": "Braces { } [ ] and , : in text", "actions": []},
+    {"actions": [{"type": "navigate", "view": "inbox"}], "message": "Actions before the message"},
+]
+
+ENCODINGS = {
+    'ascii': lambda reply: json.dumps(reply),
+    'utf8': lambda reply: json.dumps(reply, ensure_ascii=False),
+    'indented': lambda reply: json.dumps(reply, indent=2),
+    'fenced': lambda reply: "```json\n" + json.dumps(reply) + "\n```",
+}
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+@pytest.mark.parametrize('reply', REPLIES)
+def test_every_prefix_is_consistent_with_the_full_reply(reply, encoding):
+    text = ENCODINGS[encoding](reply)
+    seen_message, seen_actions = '', []
+    for end in range(len(text) + 1):
+        message, actions = _scan_partial_ai_json(text[:end])
+        assert reply["message"].startswith(message), end
+        assert actions == reply["actions"][:len(actions)], end
+        # Output only ever grows as more of the stream arrives
+        assert message.startswith(seen_message), end
+        assert actions[:len(seen_actions)] == seen_actions, end
+        seen_message, seen_actions = message, actions
+    assert (seen_message, seen_actions) == (reply["message"], reply["actions"])
+
+
+def test_no_object_yet():
+    assert _scan_partial_ai_json('') == ('', [])
+    assert _scan_partial_ai_json('```json\n') == ('', [])
+
+
+def test_cut_inside_key_yields_nothing():
+    assert _scan_partial_ai_json('{"mess') == ('', [])
+    assert _scan_partial_ai_json('{"message') == ('', [])
+
+
+def test_actions_appear_once_complete():
+    text = '{"message": "ok", "actions": [{"type": "navigate", "view": "sent"}, {"type": "fil'
+    assert _scan_partial_ai_json(text) == ('ok', [{"type": "navigate", "view": "sent"}])
+
+
+def test_message_value_inside_action_is_ignored():
+    text = '{"actions": [{"type": "compose", "message": "not this"}], "message": "this"}'
+    assert _scan_partial_ai_json(text) == ('this', [{"type": "compose", "message": "not this"}])
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('"plain"', ('plain', 7, True)),
+    ('"say \\"hi\\""', ('say "hi"', 12, True)),
+    ('"a\\\\"', ('a\\', 5, True)),
+    ('"\\n\\t\\/\\b\\f\\r"', ('\n\t/\b\f\r', 14, True)),
+    ('"\\u00e9"', ('é', 8, True)),
+    ('"\\ud83d\\ude00!"', ('😀!', 15, True)),
+])
+def test_read_complete_string(text, expected):
+    assert _read_partial_json_string(text, 0) == expected
+
+
+@pytest.mark.parametrize('text, decoded', [
+    ('"abc', 'abc'),
+    ('"ab\\', 'ab'),
+    ('"ab\\u00', 'ab'),
+    # Neither half of a surrogate pair is emitted until both have arrived
+    ('"x\\ud83d', 'x'),
+    ('"x\\ud83d\\u', 'x'),
+    ('"x\\ud83d\\ude0', 'x'),
+])
+def test_read_cut_string(text, decoded):
+    assert _read_partial_json_string(text, 0) == (decoded, len(text), False)
+
+
+def test_read_string_at_offset():
+    text = '{"message": "hi", "actions": []}'
+    start = text.index('"hi"')
+    assert _read_partial_json_string(text, start) == ('hi', start + 4, True)
@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+from server import ConnectionManager
+
+
+class FakeSocket:
+    """WebSocket stand-in; a slow one blocks in send_text until released."""
+
+    def __init__(self, slow=False):
+        self.sent = []
+        self.closed_with = None
+        self.release = asyncio.Event()
+        if not slow:
+            self.release.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        await self.release.wait()
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_burst_does_not_drop_fast_clients():
+    async def scenario():
+        manager = ConnectionManager(queue_size=5)
+        sockets = [FakeSocket() for _ in range(3)]
+        for socket in sockets:
+            await manager.connect(socket)
+        for i in range(12):
+            await manager.broadcast({"type": "event", "n": i})
+        await _settle()
+        return manager, sockets
+
+    manager, sockets = run(scenario())
+    assert manager.dropped_clients == 0
+    assert len(manager.active_connections) == 3
+    for socket in sockets:
+        assert [m["n"] for m in socket.sent if m["type"] == "event"] == list(range(12))
+        assert socket.closed_with is None
+
+
+def test_slow_client_is_dropped_and_others_keep_receiving():
+    async def scenario():
+        manager = ConnectionManager(queue_size=5)
+        fast, slow = FakeSocket(), FakeSocket(slow=True)
+        await manager.connect(fast)
+        await manager.connect(slow)
+        for i in range(12):
+            await manager.broadcast({"type": "event", "n": i})
+        await _settle()
+        return manager, fast, slow
+
+    manager, fast, slow = run(scenario())
+    assert manager.dropped_clients == 1
+    assert list(manager.active_connections) == [fast]
+    assert slow.closed_with == 1013
+    assert [m["n"] for m in fast.sent if m["type"] == "event"] == list(range(12))
+
+
+def test_reconnect_after_burst_replays_missed_events():
+    async def scenario():
+        manager = ConnectionManager(queue_size=20)
+        for i in range(5):
+            await manager.broadcast({"type": "event", "n": i})
+        socket = FakeSocket()
+        await manager.connect(socket, last_seq=2, stream=manager.stream_id)
+        await _settle()
+        return socket
+
+    socket = run(scenario())
+    assert [m["type"] for m in socket.sent] == ["hello", "event", "event", "event"]
+    assert [m["seq"] for m in socket.sent[1:]] == [3, 4, 5]
@@ -0,0 +1,101 @@
+import base64
+
+import pytest
+
+import gmail_service
+from gmail_service import _get_email_body, _html_to_text
+
+
+def part(mime, text, filename='', encoding='utf-8'):
+    data = base64.urlsafe_b64encode(text.encode(encoding)).decode()
+    return {'mimeType': mime, 'filename': filename, 'body': {'data': data}}
+
+
+def multipart(mime, *parts):
+    return {'mimeType': mime, 'filename': '', 'body': {'size': 0}, 'parts': list(parts)}
+
+
+def test_block_tags_become_line_breaks():
+    # Opening and closing tags both break the line; at most one blank line is kept
+    assert _html_to_text('<p>one</p><div>two<br>three</div>') == 'one\n\ntwo\nthree'
+    assert _html_to_text('one<br>two<br><br><br><br>three') == 'one\ntwo\n\nthree'
+
+
+def test_table_cells_are_separated():
+    html_body = '<table><tr><th>Name</th><th>Value</th></tr><tr><td>Total</td><td>$5</td></tr></table>'
+    assert _html_to_text(html_body) == 'Name Value\n\nTotal $5'
+
+
+def test_entities_are_decoded_and_spaces_collapsed():
+    assert _html_to_text('<p>Tom&nbsp;&amp;&nbsp;Jerry &lt;3   &eacute;t&eacute;</p>') == 'Tom & Jerry <3 été'
+
+
+def test_script_style_head_and_comments_are_dropped():
+    html_body = ('<html><head><title>T</title><style>p {color: red}</style></head>'
+                 '<body><!-- hidden --><p>shown</p><script>var x = "<p>no</p>";</script></body></html>')
+    assert _html_to_text(html_body) == 'shown'
+
+
+@pytest.mark.parametrize('html_body', [
+    '<p>hi</p><script>var secret = "leak";xxxxxxxxxxxxxxxxxxxx</script><p>after</p>',
+    '<p>hi</p><style>.secret { color: red }xxxxxxxxxxxxxxxxxxxxx</style><p>after</p>',
+    '<p>hi</p><!-- secret comment xxxxxxxxxxxxxxxxxxxxxxxxx --><p>after</p>',
+    '<p>hi</p><a href="https://example.com/secret-link-xxxxxxxxxxxxxxx">x</a>',
+])
+def test_truncation_does_not_leak_markup(monkeypatch, html_body):
+    monkeypatch.setattr(gmail_service, 'HTML_TEXT_MAX_CHARS', 40)
+    assert _html_to_text(html_body) == 'hi'
+
+
+def test_text_after_the_cap_is_ignored(monkeypatch):
+    monkeypatch.setattr(gmail_service, 'HTML_TEXT_MAX_CHARS', 12)
+    assert _html_to_text('<p>first</p><p>second</p>') == 'first'
+
+
+def test_single_part_plain():
+    assert _get_email_body(part('text/plain', '  hello  ')) == ('hello', '')
+
+
+def test_alternative_keeps_plain_and_html():
+    payload = multipart('multipart/alternative', part('text/plain', 'plain'), part('text/html', '<p>html</p>'))
+    assert _get_email_body(payload) == ('plain', '<p>html</p>')
+
+
+def test_html_only_derives_text():
+    payload = multipart('multipart/alternative', part('text/html', '<p>Hello&nbsp;there</p>'))
+    assert _get_email_body(payload) == ('Hello there', '<p>Hello&nbsp;there</p>')
+
+
+def test_first_plain_part_wins_depth_first():
+    payload = multipart(
+        'multipart/mixed',
+        multipart('multipart/alternative', part('text/plain', 'first'), part('text/html', '<b>first</b>')),
+        part('text/plain', 'second'),
+        part('text/html', '<b>second</b>'),
+    )
+    assert _get_email_body(payload) == ('first', '<b>first</b>')
+
+
+def test_attachments_are_skipped():
+    payload = multipart(
+        'multipart/mixed',
+        part('text/plain', 'attached notes', filename='notes.txt'),
+        part('text/html', '<p>attached page</p>', filename='page.html'),
+        part('text/html', '<p>body</p>'),
+    )
+    assert _get_email_body(payload) == ('body', '<p>body</p>')
+
+
+def test_parts_without_data_are_skipped():
+    payload = multipart('multipart/mixed', {'mimeType': 'text/plain', 'filename': '', 'body': {'size': 0}},
+                        part('text/plain', 'real'))
+    assert _get_email_body(payload) == ('real', '')
+
+
+def test_invalid_utf8_is_replaced():
+    text, _ = _get_email_body(part('text/plain', 'café', encoding='latin-1'))
+    assert text == 'caf�'
+
+
+def test_empty_payload():
+    assert _get_email_body({'mimeType': 'text/plain', 'body': {'size': 0}}) == ('', '')
@@ -0,0 +1,169 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import gmail_quota
+from gmail_quota import GmailQuota, TokenBucket
+
+
+class FakeClock:
+    """Stands in for the time module: sleep() advances monotonic() instantly."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(gmail_quota, 'time', fake)
+    return fake
+
+
+def http_error(status, headers=None, reason=''):
+    content = b'{}'
+    if reason:
+        content = b'{"error": {"errors": [{"reason": "%s"}]}}' % reason.encode()
+    return HttpError(httplib2.Response({'status': status, **(headers or {})}), content)
+
+
+def test_acquire_within_capacity_does_not_wait(clock):
+    bucket = TokenBucket(rate=10, capacity=50)
+    assert bucket.acquire(20) == 0
+    assert bucket.acquire(30) == 0
+    assert bucket.snapshot() == (0, 0)
+    assert clock.sleeps == []
+
+
+def test_acquire_waits_for_refill(clock):
+    bucket = TokenBucket(rate=10, capacity=50)
+    bucket.acquire(50)
+    assert bucket.acquire(5) == pytest.approx(0.5)
+    assert clock.now == pytest.approx(1000.5)
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = TokenBucket(rate=10, capacity=50)
+    bucket.acquire(50)
+    clock.now += 60
+    assert bucket.snapshot()[0] == 50
+
+
+def test_oversized_request_waits_for_a_full_bucket_then_goes_into_debt(clock):
+    bucket = TokenBucket(rate=10, capacity=50)
+    bucket.acquire(30)
+    # Needs the whole bucket (2s to refill the missing 30), then leaves it 70 in debt
+    assert bucket.acquire(120) == pytest.approx(3.0)
+    assert bucket.snapshot()[0] == pytest.approx(-70)
+    # The debt is paid back before the next caller gets through
+    assert bucket.acquire(10) == pytest.approx(8.0)
+
+
+def test_pause_holds_every_caller(clock):
+    bucket = TokenBucket(rate=10, capacity=50)
+    bucket.pause(2)
+    assert bucket.snapshot() == (50, 2)
+    assert bucket.acquire(1) == pytest.approx(2)
+    assert bucket.snapshot() == (49, 0)
+
+
+def test_pause_never_shortens_an_existing_pause(clock):
+    bucket = TokenBucket(rate=10, capacity=50)
+    bucket.pause(5)
+    bucket.pause(1)
+    assert bucket.snapshot()[1] == 5
+
+
+def test_pause_and_refill_overlap(clock):
+    bucket = TokenBucket(rate=10, capacity=50)
+    bucket.acquire(50)
+    bucket.pause(1)
+    # Refilling continues during the pause: 1s of pause covers 10 of the 30 units
+    assert bucket.acquire(30) == pytest.approx(3)
+
+
+def quota(**overrides):
+    settings = dict(units_per_second=1000, burst=1000, max_concurrency=2,
+                    max_retries=3, base_delay=0.5, max_delay=8)
+    settings.update(overrides)
+    return GmailQuota(**settings)
+
+
+def failing(*errors, result='ok'):
+    """send() raising each error in turn, then returning result."""
+    remaining = list(errors)
+    calls = []
+
+    def send():
+        calls.append(1)
+        if remaining:
+            raise remaining.pop(0)
+        return result
+    send.calls = calls
+    return send
+
+
+def test_rate_limit_is_retried_after_retry_after(clock):
+    q = quota()
+    send = failing(http_error(429, {'retry-after': '3'}))
+    assert q.call(send, units=5) == 'ok'
+    assert len(send.calls) == 2
+    # Paused by the 429, then waited at least Retry-After before resending
+    assert sum(clock.sleeps) >= 3
+    assert q.counters['rate_limited'] == 1 and q.counters['retries'] == 1
+
+
+def test_403_rate_limit_reason_is_retried(clock):
+    q = quota()
+    send = failing(http_error(403, reason='userRateLimitExceeded'))
+    assert q.call(send, units=5) == 'ok'
+    assert len(send.calls) == 2
+
+
+def test_other_403_is_not_retried(clock):
+    q = quota()
+    send = failing(http_error(403, reason='insufficientPermissions'))
+    with pytest.raises(HttpError):
+        q.call(send, units=5)
+    assert len(send.calls) == 1
+
+
+def test_server_error_is_not_retried_for_non_idempotent_calls(clock):
+    q = quota()
+    send = failing(http_error(503))
+    with pytest.raises(HttpError):
+        q.call(send, units=100, idempotent=False)
+    assert len(send.calls) == 1
+    assert q.counters['server_errors'] == 1
+
+
+def test_rate_limit_is_retried_for_non_idempotent_calls(clock):
+    q = quota()
+    send = failing(http_error(429))
+    assert q.call(send, units=100, idempotent=False) == 'ok'
+
+
+def test_gives_up_after_max_retries(clock):
+    q = quota(max_retries=2)
+    send = failing(*[http_error(503)] * 5)
+    with pytest.raises(HttpError):
+        q.call(send, units=5)
+    assert len(send.calls) == 3
+    assert q.counters['gave_up'] == 1
+
+
+def test_backoff_is_capped(clock):
+    q = quota(base_delay=1, max_delay=4)
+    assert all(0 <= q.backoff(attempt) <= 4 for attempt in range(10))
+    assert q.backoff(0, http_error(429, {'retry-after': '60'})) == 4
@@ -0,0 +1,120 @@
+from gmail_service import _collect_history_changes
+
+
+def _message(msg_id, labels=()):
+    return {'message': {'id': msg_id, 'threadId': msg_id, 'labelIds': list(labels)}}
+
+
+def added(msg_id, labels=('INBOX', 'UNREAD')):
+    return {'messagesAdded': [_message(msg_id, labels)]}
+
+
+def deleted(msg_id):
+    return {'messagesDeleted': [_message(msg_id)]}
+
+
+def labels_added(msg_id, changed, current=('INBOX',)):
+    return {'labelsAdded': [{**_message(msg_id, current), 'labelIds': list(changed)}]}
+
+
+def labels_removed(msg_id, changed, current=('INBOX',)):
+    return {'labelsRemoved': [{**_message(msg_id, current), 'labelIds': list(changed)}]}
+
+
+def test_empty_history():
+    assert _collect_history_changes([]) == ([], {}, set())
+
+
+def test_added_messages_keep_order_without_duplicates():
+    history = [added('a'), added('b'), added('a')]
+    assert _collect_history_changes(history) == (['a', 'b'], {}, set())
+
+
+def test_read_and_star_changes():
+    history = [
+        labels_removed('a', ['UNREAD']),
+        labels_added('b', ['UNREAD']),
+        labels_added('c', ['STARRED']),
+        labels_removed('d', ['STARRED']),
+    ]
+    _, updates, _ = _collect_history_changes(history)
+    assert updates == {
+        'a': {'is_read': True},
+        'b': {'is_read': False},
+        'c': {'starred': True},
+        'd': {'starred': False},
+    }
+
+
+def test_later_label_changes_win():
+    history = [
+        labels_removed('a', ['UNREAD']),
+        labels_added('a', ['STARRED']),
+        labels_added('a', ['UNREAD']),
+    ]
+    _, updates, _ = _collect_history_changes(history)
+    assert updates == {'a': {'is_read': False, 'starred': True}}
+
+
+def test_unrelated_labels_produce_no_update():
+    history = [labels_added('a', ['IMPORTANT', 'Label_1']), labels_removed('b', ['CATEGORY_UPDATES'])]
+    assert _collect_history_changes(history) == ([], {}, set())
+
+
+def test_deleted_message_is_neither_added_nor_updated():
+    history = [added('a'), labels_removed('a', ['UNREAD']), deleted('a')]
+    assert _collect_history_changes(history) == ([], {}, {'a'})
+
+
+def test_trash_and_spam_count_as_deleted():
+    history = [
+        labels_added('a', ['TRASH'], current=('TRASH',)),
+        labels_added('b', ['SPAM', 'UNREAD'], current=('SPAM', 'UNREAD')),
+    ]
+    assert _collect_history_changes(history) == ([], {}, {'a', 'b'})
+
+
+def test_restored_from_trash_is_added_again():
+    history = [
+        labels_added('a', ['TRASH'], current=('TRASH',)),
+        labels_removed('a', ['TRASH'], current=('INBOX',)),
+    ]
+    assert _collect_history_changes(history) == (['a'], {}, set())
+
+
+def test_restored_from_trash_outside_synced_folders_stays_deleted():
+    history = [
+        labels_added('a', ['TRASH'], current=('TRASH',)),
+        labels_removed('a', ['TRASH'], current=('Label_1',)),
+    ]
+    assert _collect_history_changes(history) == ([], {}, {'a'})
+
+
+def test_archived_inbox_message_is_removed():
+    history = [labels_removed('a', ['INBOX'], current=())]
+    assert _collect_history_changes(history) == ([], {}, {'a'})
+
+
+def test_archived_sent_message_is_kept():
+    history = [labels_removed('a', ['INBOX'], current=('SENT',))]
+    assert _collect_history_changes(history) == ([], {}, set())
+
+
+def test_archive_and_read_in_one_window():
+    history = [labels_removed('a', ['INBOX', 'UNREAD'], current=())]
+    assert _collect_history_changes(history) == ([], {}, {'a'})
+
+
+def test_moved_back_into_inbox_is_added():
+    history = [labels_removed('a', ['INBOX'], current=()), labels_added('a', ['INBOX'])]
+    assert _collect_history_changes(history) == (['a'], {}, set())
+
+
+def test_added_archived_and_moved_back_in_one_window():
+    history = [added('a'), labels_removed('a', ['INBOX'], current=()), labels_added('a', ['INBOX'])]
+    assert _collect_history_changes(history) == (['a'], {}, set())
+
+
+def test_added_then_archived_in_one_window():
+    history = [added('a'), labels_removed('a', ['INBOX'], current=())]
+    assert _collect_history_changes(history) == ([], {}, {'a'})
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import jwt
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+import server
+
+
+class FakeBlacklist:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, *args):
+        return self
+
+    async def to_list(self, length):
+        return list(self.docs)
+
+
+@pytest.fixture
+def blacklist(monkeypatch):
+    fake = FakeBlacklist([])
+    monkeypatch.setattr(server, 'db', type('FakeDB', (), {'jwt_blacklist': fake})())
+    monkeypatch.setattr(server, 'revoked_token_hashes', {})
+    monkeypatch.setattr(server, 'jwt_verify_cache', server.OrderedDict())
+    return fake
+
+
+def authenticate(token):
+    credentials = HTTPAuthorizationCredentials(scheme='Bearer', credentials=token)
+    return asyncio.run(server.get_current_user(credentials))
+
+
+def test_local_revocation_survives_a_refresh_that_misses_it(blacklist):
+    token = server.create_jwt_token('me@example.com')
+    assert authenticate(token) == 'me@example.com'
+    server.revoke_token(token)
+    # Mongo has not seen the logout's write yet
+    asyncio.run(server.load_revoked_tokens())
+    with pytest.raises(HTTPException) as error:
+        authenticate(token)
+    assert error.value.detail == 'Token has been revoked'
+
+
+def test_refresh_merges_revocations_from_other_processes(blacklist):
+    token = server.create_jwt_token('me@example.com')
+    assert authenticate(token) == 'me@example.com'
+    blacklist.docs.append({'token': token, 'token_hash': server._token_hash(token)})
+    asyncio.run(server.load_revoked_tokens())
+    with pytest.raises(HTTPException):
+        authenticate(token)
+
+
+def test_refresh_prunes_only_expired_tokens(blacklist):
+    live = server.create_jwt_token('me@example.com')
+    expired = jwt.encode({'email': 'me@example.com', 'exp': int(time.time()) - 10},
+                         server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)
+    server.revoke_token(live)
+    server.revoke_token(expired)
+    asyncio.run(server.load_revoked_tokens())
+    assert set(server.revoked_token_hashes) == {server._token_hash(live)}